@@ -3,11 +3,13 @@ import json
 import time
 import uuid
 import re
+import html
+import unicodedata
 import logging
 import asyncio
 import threading
-import subprocess
-import requests
+import signal
+import resource
 import boto3
 import aiohttp
 import yt_dlp
@@ -16,6 +18,13 @@ import traceback
 import asyncpg
 import ssl
 import sys
+import heapq
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit, unquote
 from telegram import (
@@ -24,6 +33,7 @@ from telegram import (
     InlineKeyboardMarkup,
     InlineQueryResultCachedDocument,
     InlineQueryResultCachedVideo,
+    InputMediaAudio,
 )
 from telegram.ext import (
     ApplicationBuilder,
@@ -35,7 +45,7 @@ from telegram.ext import (
     ContextTypes,
     InlineQueryHandler,
 )
-from telegram.error import TimedOut
+from telegram.error import BadRequest, TimedOut
 
 # Always disable .pyc generation regardless of launch mode.
 sys.dont_write_bytecode = True
@@ -45,6 +55,7 @@ IMPORTANT_DIR = os.path.join(BASE_DIR, 'important')
 CONFIG_PATH = os.path.join(IMPORTANT_DIR, 'config.json')
 SSL_ROOT_CERT = os.path.join(IMPORTANT_DIR, 'root.crt')
 INSTAGRAM_HELPER = os.path.join(BASE_DIR, "download_instagram.sh")
+INSTAGRAM_DEFAULT_COOKIES = os.path.join(IMPORTANT_DIR, "www.instagram.com_cookies.txt")
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger("MediaBot")
@@ -159,10 +170,94 @@ def normalize_link_for_cache(link):
     except Exception:
         return raw
 
+
+YOUTUBE_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+
+def canonical_content_id(link):
+    """
+    Maps a media URL to a platform content ID (yt:<id>, ig:<shortcode>, rd:<postid>, ...).
+    Returns None for unknown URL shapes so callers can fall back to normalize_link_for_cache.
+    """
+    try:
+        parsed = urlsplit((link or "").strip())
+        host = (parsed.hostname or "").lower()
+        for prefix in ("www.", "m."):
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+        parts = [p for p in (parsed.path or "").split("/") if p]
+        params = dict(parse_qsl(parsed.query, keep_blank_values=False))
+
+        def _after(markers):
+            for i, part in enumerate(parts[:-1]):
+                if part.lower() in markers:
+                    return parts[i + 1]
+            return None
+
+        if host == "youtu.be" or host in {"youtube.com", "music.youtube.com", "youtube-nocookie.com"}:
+            if host == "youtu.be":
+                video_id = parts[0] if parts else None
+            else:
+                video_id = _after({"shorts", "embed", "live", "v"}) or params.get("v")
+            if video_id and YOUTUBE_VIDEO_ID_RE.match(video_id):
+                return f"yt:{video_id}"
+        elif host == "tiktok.com" or host.endswith(".tiktok.com"):
+            post_id = _after({"video", "photo"})
+            if post_id and post_id.isdigit():
+                return f"tt:{post_id}"
+        elif host == "instagram.com":
+            shortcode = _after({"p", "reel", "reels", "tv"})
+            if shortcode:
+                return f"ig:{shortcode}"
+        elif host == "redd.it":
+            if parts:
+                return f"rd:{parts[0].lower()}"
+        elif host == "v.redd.it":
+            if parts:
+                return f"rdv:{parts[0].lower()}"
+        elif host == "reddit.com" or host.endswith(".reddit.com"):
+            post_id = _after({"comments"})
+            if post_id:
+                return f"rd:{post_id.lower()}"
+        elif "pornhub." in host:
+            viewkey = params.get("viewkey")
+            if viewkey:
+                return f"ph:{viewkey}"
+        elif "pinterest." in host:
+            pin = _after({"pin"})
+            if pin:
+                match = re.search(r"(\d+)$", pin)
+                return f"pin:{match.group(1) if match else pin}"
+        elif host.startswith("music.yandex."):
+            track_id = _after({"track"})
+            if track_id and track_id.isdigit():
+                return f"ym:track:{track_id}"
+            album_id = _after({"album"})
+            if album_id and album_id.isdigit():
+                return f"ym:album:{album_id}"
+        elif host == "open.spotify.com":
+            for kind in ("track", "album", "episode"):
+                item_id = _after({kind})
+                if item_id:
+                    return f"sp:{kind}:{item_id}"
+    except Exception:
+        return None
+    return None
+
 # Core config
 BOT_TOKEN = cfg("telegram.bot_token")
 ADMIN_ID = cfg("telegram.admin_id")
 DB_CONFIG = cfg("database")
+# asyncpg pool; behind pgbouncer in transaction mode (pre-1.21) set statement_cache_size to 0
+DB_POOL_MIN_SIZE = max(0, int(cfg("database.pool.min_size", 2)))
+DB_POOL_MAX_SIZE = max(1, DB_POOL_MIN_SIZE, int(cfg("database.pool.max_size", 10)))
+DB_STATEMENT_CACHE_SIZE = max(0, int(cfg("database.pool.statement_cache_size", 100)))
+DB_COMMAND_TIMEOUT_SEC = float(cfg("database.pool.command_timeout_sec", 30)) or None
+# Startup migrations/backfills scan whole tables; they get their own, much longer timeout
+DB_MIGRATION_TIMEOUT_SEC = float(cfg("database.pool.migration_timeout_sec", 3600)) or None
+DB_MAX_INACTIVE_CONNECTION_LIFETIME_SEC = float(cfg("database.pool.max_inactive_connection_lifetime_sec", 300))
+DB_POOL_HEALTH_INTERVAL_SEC = max(5, int(cfg("database.pool.health_interval_sec", 60)))
+DB_POOL_ACQUIRE_WARN_MS = float(cfg("database.pool.acquire_warn_ms", 200))
 TELEGRAM_API_BASE_URL = cfg("telegram.api_base_url", "https://tg.s-grishin.ru")
 
 if not BOT_TOKEN: exit("CRITICAL: BOT_TOKEN missing")
@@ -171,20 +266,59 @@ if not BOT_TOKEN: exit("CRITICAL: BOT_TOKEN missing")
 PROXIES = cfg("network.proxies", {})
 COOKIES = {k: os.path.join(BASE_DIR, v) for k, v in cfg("network.cookies", {}).items()}
 HEADERS = cfg("network.headers", {})
+# Shared outbound HTTP client (aiohttp)
+HTTP_TIMEOUT_SEC = float(cfg("network.http.timeout_sec", 30))
+HTTP_CONNECT_TIMEOUT_SEC = float(cfg("network.http.connect_timeout_sec", 10))
+HTTP_POOL_LIMIT = int(cfg("network.http.pool_limit", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(cfg("network.http.pool_limit_per_host", 10))
+HTTP_DNS_CACHE_TTL_SEC = int(cfg("network.http.dns_cache_ttl_sec", 300))
+HTTP_KEEPALIVE_TIMEOUT_SEC = float(cfg("network.http.keepalive_timeout_sec", 30))
 YSK = cfg("integrations.yandex.speechkit", {})
 YGPT = cfg("integrations.yandex.gpt", {})
 RAPID_API_KEY = cfg("integrations.rapid_api.key")
 REDDIT_CONFIG = cfg("integrations.reddit", {})
+INSTAGRAM_CONFIG = cfg("integrations.instagram", {}) or {}
+# Legacy shell helper (download_instagram.sh) instead of the in-process pipeline
+INSTAGRAM_USE_HELPER_SCRIPT = bool(INSTAGRAM_CONFIG.get("use_helper_script", False))
+# Fetch resolved CDN parts without the proxy (the proxy is only needed for extraction)
+INSTAGRAM_DIRECT_PARTS = bool(INSTAGRAM_CONFIG.get("direct_parts", True))
 
 # Limits/performance config
 MAX_FILE_SIZE = int(cfg("limits.max_file_size_mb", 200)) * 1024 * 1024
-DOWNLOAD_SEMAPHORE = asyncio.Semaphore(int(cfg("limits.download_concurrency", 4)))
+DOWNLOAD_CONCURRENCY = int(cfg("limits.download_concurrency", 4))
+# Scheduler service -> max concurrent jobs; services not listed are bounded only by download_concurrency
+SERVICE_CONCURRENCY = cfg("limits.service_concurrency", {
+    "YouTube": 4, "Instagram": 2, "Reddit": 2, "PornHub": 1, "Music": 3,
+})
+SCHEDULER_WAIT_LOG_SEC = float(cfg("limits.scheduler_wait_log_sec", 1))
+PER_USER_DOWNLOAD_CONCURRENCY = int(cfg("limits.per_user_download_concurrency", 2))
+QUEUE_POSITION_UPDATE_SEC = max(1.0, float(cfg("limits.queue_position_update_sec", 3)))
 SEND_SEMAPHORE = asyncio.Semaphore(int(cfg("limits.send_concurrency", 5)))
 ALBUM_TRACK_CONCURRENCY = int(cfg("limits.album_track_concurrency", 3))
+ALBUM_RESOLVE_CONCURRENCY = int(cfg("limits.album_resolve_concurrency", 4))
+ALBUM_TRANSCODE_CONCURRENCY = int(cfg("limits.album_transcode_concurrency", 2))
+ALBUM_QUEUE_SIZE = max(1, int(cfg("limits.album_queue_size", 4)))
+# Partial media group is sent once the next track has kept it waiting this long
+ALBUM_BATCH_FLUSH_SEC = max(0.5, float(cfg("limits.album_batch_flush_sec", 5)))
+# Shared by all albums in flight, so concurrent albums cannot multiply ffmpeg load
+ALBUM_TRANSCODE_SEMAPHORE = asyncio.Semaphore(max(1, ALBUM_TRANSCODE_CONCURRENCY))
+MEDIA_GROUP_MAX = 10  # Bot API limit for sendMediaGroup
 ADMIN_BUTTON_CHUNK_SIZE = int(cfg("limits.admin_button_chunk_size", 50))
 CLEANUP_INTERVAL_SEC = int(cfg("limits.cleanup_interval_sec", 3600))
 CLEANUP_TTL_SEC = int(cfg("limits.cleanup_ttl_sec", 3600))
 SHARE_TOKEN_TTL_SEC = int(cfg("limits.share_token_ttl_sec", 21600))
+CACHE_LRU_SIZE = int(cfg("limits.cache_lru_size", 5000))
+CACHE_TTL_SEC = int(cfg("limits.cache_ttl_sec", 3600))
+CACHE_NEGATIVE_TTL_SEC = int(cfg("limits.cache_negative_ttl_sec", 30))
+SHORT_LINK_TTL_SEC = int(cfg("limits.short_link_ttl_sec", 86400))
+MUSIC_METADATA_TTL_SEC = int(cfg("limits.music_metadata_ttl_sec", 604800))
+SHORT_LINK_RESOLVE_TIMEOUT_SEC = int(cfg("limits.short_link_resolve_timeout_sec", 5))
+LOG_FLUSH_INTERVAL_SEC = float(cfg("limits.log_flush_interval_sec", 2))
+LOG_FLUSH_BATCH_SIZE = int(cfg("limits.log_flush_batch_size", 200))
+# 0 keeps requests_log forever; rollup tables are never trimmed.
+REQUESTS_LOG_RETENTION_MONTHS = max(0, int(cfg("database.requests_log.retention_months", 0) or 0))
+REQUESTS_LOG_PARTITIONS_AHEAD = max(1, int(cfg("database.requests_log.partitions_ahead", 1) or 1))
+REQUESTS_LOG_MIGRATION_BATCH = max(1000, int(cfg("database.requests_log.migration_batch_rows", 50000) or 50000))
 
 # UX/messages config
 ERROR_MSG_USER = cfg("messages.error_user", "Error. Try again later or check the link")
@@ -198,6 +332,9 @@ STATUS_ANALYZING = cfg("messages.status.analyzing", "⏳ Analyzing...")
 STATUS_SENDING = cfg("messages.status.sending", "📤 Sending...")
 STATUS_LISTENING = cfg("messages.status.listening", "☁️ Listening...")
 STATUS_ALBUM = cfg("messages.status.album", "💿 Album: {count} tracks...")
+STATUS_ALBUM_PROGRESS = cfg("messages.status.album_progress", "💿 Album: {done}/{count} tracks sent...")
+STATUS_ALBUM_PARTIAL = cfg("messages.status.album_partial", "💿 Album: sent {sent} of {count} tracks.")
+STATUS_QUEUED = cfg("messages.status.queued", "🕒 In queue: #{position}")
 START_MESSAGE = cfg("messages.start", "MediaBot Ready (DB Caching).")
 DONATION_ENABLED = cfg_bool("donations.enabled", False)
 DONATION_PRIVATE_ONLY = cfg_bool("donations.private_only", True)
@@ -280,6 +417,24 @@ elif isinstance(_ytdlp_js_runtimes_cfg, dict):
     YTDLP_JS_RUNTIMES = _ytdlp_js_runtimes_cfg
 else:
     YTDLP_JS_RUNTIMES = {}
+# Raw (unprocessed) yt-dlp info dicts; format URLs expire, so keep the TTL short
+YTDLP_INFO_CACHE_TTL_SEC = int(cfg("downloads.ytdlp.info_cache_ttl_sec", 300))
+YTDLP_INFO_CACHE_SIZE = int(cfg("downloads.ytdlp.info_cache_size", 256))
+# Optional process pool for in-process yt-dlp (keeps extraction/merging off the bot's GIL)
+YTDLP_PROCESS_POOL_ENABLED = bool(cfg("downloads.ytdlp.process_pool.enabled", False))
+YTDLP_PROCESS_POOL_WORKERS = max(1, int(cfg("downloads.ytdlp.process_pool.workers", 0) or (os.cpu_count() or 1)))
+YTDLP_INSTAGRAM_FORMAT = cfg(
+    "downloads.ytdlp.instagram_format",
+    "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+)
+YTDLP_MUSIC_FORMAT = cfg("downloads.ytdlp.music_format", "bestaudio[ext=m4a]/bestaudio/best")
+# Audio codecs remuxed with -c:a copy instead of being re-encoded to MP3
+AUDIO_COPY_CONTAINERS = {"aac": "m4a", "alac": "m4a", "mp3": "mp3", "opus": "ogg"}
+AUDIO_COPY_CODECS = set(cfg("downloads.audio.copy_codecs", ["aac", "mp3"])) & set(AUDIO_COPY_CONTAINERS)
+AUDIO_TRANSCODE_BITRATE = str(cfg("downloads.audio.transcode_bitrate", "192k"))
+# Video streams that can be remuxed into mp4 instead of re-encoded
+TELEGRAM_H264_PROFILES = {"Baseline", "Constrained Baseline", "Main", "High"}
+TELEGRAM_PIX_FMTS = {"yuv420p", "yuvj420p"}
 FORCE_CONVERSION_SERVICES = set(cfg("features.force_conversion_services", ["Instagram", "Reddit"]))
 
 # Feature toggles/data
@@ -297,6 +452,14 @@ MAX_UPDATE_AGE_SEC = int(cfg("features.max_update_age_sec", 300))
 PROXY_CHECK_URL = cfg("features.proxy_watchdog.url", "https://api.ipify.org?format=json")
 PROXY_CHECK_TIMEOUT_SEC = int(cfg("features.proxy_watchdog.timeout_sec", 15))
 REDDIT_SHORT_RESOLVE_TIMEOUT_SEC = int(cfg("features.reddit_short_resolve_timeout_sec", 15))
+# External processes (yt-dlp CLI, Instagram helper, ffmpeg, curl)
+DOWNLOAD_PROCESS_TIMEOUT_SEC = int(cfg("limits.download_process_timeout_sec", 600))
+FFMPEG_TIMEOUT_SEC = int(cfg("limits.ffmpeg_timeout_sec", 900))
+PROCESS_STDERR_LIMIT_BYTES = int(cfg("limits.process_stderr_limit_bytes", 65536))
+DIRECT_DOWNLOAD_TIMEOUT_SEC = int(cfg("limits.direct_download_timeout_sec", 300))
+DIRECT_DOWNLOAD_CHUNK_BYTES = 256 * 1024
+RANGED_DOWNLOAD_CONNECTIONS = max(1, int(cfg("limits.ranged_download_connections", 4)))
+RANGED_DOWNLOAD_MIN_BYTES = int(cfg("limits.ranged_download_min_mb", 8)) * 1024 * 1024
 PROXY6_CONFIG = cfg("integrations.proxy6", {})
 PROXY6_API_KEY = os.getenv("PROXY6_API_KEY") or PROXY6_CONFIG.get("api_key")
 PROXY6_API_BASE_URL = PROXY6_CONFIG.get("api_base_url", "https://px6.link/api")
@@ -330,31 +493,570 @@ if YSK.get("S3_ACCESS_KEY_ID"):
                                  aws_secret_access_key=YSK.get("S3_SECRET_ACCESS_KEY"))
     except Exception as e: logger.error(f"S3 Init Error: {e}")
 
+class MediaCacheLRU:
+    """
+    Bounded in-process LRU with TTL in front of the DB cache, keyed by (link, variant).
+    Stores positive entries ({"file_id", "media_kind"}) and short-lived negative ones (None).
+    """
+
+    MISS = object()
+
+    def __init__(self, max_size, ttl_sec, negative_ttl_sec):
+        self.max_size = max(1, int(max_size))
+        self.ttl_sec = max(1, int(ttl_sec))
+        self.negative_ttl_sec = max(0, int(negative_ttl_sec))
+        self._items = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return self.MISS
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            self._items.pop(key, None)
+            self.misses += 1
+            return self.MISS
+        self._items.move_to_end(key)
+        if value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not key:
+            return
+        ttl = self.ttl_sec if value is not None else self.negative_ttl_sec
+        if ttl <= 0:
+            self._items.pop(key, None)
+            return
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        self._items.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Hot statements keep fixed text so asyncpg's per-connection statement cache prepares them once.
+SQL_MEDIA_CACHE_LOOKUP_ANY = """
+    UPDATE media_cache SET last_hit_at = CURRENT_TIMESTAMP
+    WHERE cache_key = ANY($1::text[]) AND variant = $2
+    RETURNING cache_key, file_id, media_kind
+"""
+SQL_MEDIA_CACHE_UPSERT = """
+    INSERT INTO media_cache (cache_key, variant, file_id, media_kind, file_size, service, created_at, last_hit_at)
+    VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT (cache_key, variant)
+    DO UPDATE SET
+        file_id = EXCLUDED.file_id,
+        media_kind = EXCLUDED.media_kind,
+        file_size = EXCLUDED.file_size,
+        service = EXCLUDED.service,
+        last_hit_at = CURRENT_TIMESTAMP
+"""
+SQL_PRIVATE_STATS_UPSERT = """
+    INSERT INTO user_private_media_stats (user_id, success_count, updated_at)
+    VALUES ($1, $2, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id)
+    DO UPDATE SET
+        success_count = user_private_media_stats.success_count + EXCLUDED.success_count,
+        updated_at = CURRENT_TIMESTAMP
+"""
+SQL_SHARE_TOKEN_INSERT = """
+    INSERT INTO share_tokens (token, file_id, media_kind, caption, expires_at)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (token) DO NOTHING
+"""
+
+
+class WriteBehindBuffer:
+    """
+    Collects requests_log rows, private-media counter increments and share tokens
+    off the hot path and flushes them in one transaction on a size or time trigger.
+    """
+
+    LOG_COLUMNS = ["user_id", "username", "chat_id", "link", "service", "file_id", "media_kind"]
+
+    def __init__(self, batch_size, interval_sec):
+        self.batch_size = max(1, int(batch_size))
+        self.interval_sec = max(0.1, float(interval_sec))
+        # Failed batches are retried, but never grow past this many pending rows.
+        self.max_pending = self.batch_size * 50
+        self.log_rows = []
+        self.private_success = {}
+        self.share_tokens = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def pending(self):
+        return len(self.log_rows) + len(self.private_success) + len(self.share_tokens)
+
+    def add_log(self, row):
+        self.log_rows.append(row)
+        if len(self.log_rows) > self.max_pending:
+            # Writer not running or DB down for long: keep the newest rows only.
+            del self.log_rows[:len(self.log_rows) - self.max_pending]
+        if len(self.log_rows) >= self.batch_size:
+            self._wakeup.set()
+
+    def add_private_success(self, user_id):
+        self.private_success[user_id] = self.private_success.get(user_id, 0) + 1
+        if len(self.private_success) >= self.batch_size:
+            self._wakeup.set()
+
+    def add_share_token(self, row):
+        self.share_tokens.append(row)
+        if len(self.share_tokens) >= self.batch_size:
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Shielded so shutdown cannot abort a batch halfway through its transaction.
+            await asyncio.shield(self.flush())
+
+    async def _update_rollups(self, conn, rows):
+        per_service, per_chat, per_user = {}, {}, {}
+        for user_id, _username, chat_id, _link, service, *_ in rows:
+            key = service or "Unknown"
+            per_service[key] = per_service.get(key, 0) + 1
+            if chat_id:
+                per_chat[chat_id] = per_chat.get(chat_id, 0) + 1
+            if user_id:
+                per_user[user_id] = per_user.get(user_id, 0) + 1
+        await conn.executemany(
+            """
+            INSERT INTO requests_daily_rollup (day, service, requests)
+            VALUES (CURRENT_DATE, $1, $2)
+            ON CONFLICT (day, service)
+            DO UPDATE SET requests = requests_daily_rollup.requests + EXCLUDED.requests
+            """,
+            list(per_service.items()),
+        )
+        for table, column, counts in (("chat_rollup", "chat_id", per_chat), ("user_rollup", "user_id", per_user)):
+            if counts:
+                await conn.executemany(
+                    f"""
+                    INSERT INTO {table} ({column}, requests, first_seen_at, last_seen_at)
+                    VALUES ($1, $2, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    ON CONFLICT ({column})
+                    DO UPDATE SET
+                        requests = {table}.requests + EXCLUDED.requests,
+                        last_seen_at = CURRENT_TIMESTAMP
+                    """,
+                    list(counts.items()),
+                )
+
+    async def flush(self):
+        async with self._lock:
+            rows, self.log_rows = self.log_rows, []
+            increments, self.private_success = self.private_success, {}
+            tokens, self.share_tokens = self.share_tokens, []
+            if not rows and not increments and not tokens:
+                return
+            if not db_pool:
+                return
+            try:
+                async with db_pool.acquire() as conn:
+                    async with conn.transaction():
+                        if rows:
+                            await conn.copy_records_to_table("requests_log", records=rows, columns=self.LOG_COLUMNS)
+                            await self._update_rollups(conn, rows)
+                        if increments:
+                            await conn.executemany(SQL_PRIVATE_STATS_UPSERT, list(increments.items()))
+                        if tokens:
+                            await conn.executemany(SQL_SHARE_TOKEN_INSERT, tokens)
+            except Exception as e:
+                logger.error(
+                    f"⚠️ Write-behind flush error ({len(rows)} rows, {len(increments)} counters, {len(tokens)} tokens): {e}"
+                )
+                if len(rows) + len(self.log_rows) <= self.max_pending:
+                    self.log_rows[:0] = rows
+                if len(tokens) + len(self.share_tokens) <= self.max_pending:
+                    self.share_tokens[:0] = tokens
+                for user_id, delta in increments.items():
+                    self.private_success[user_id] = self.private_success.get(user_id, 0) + delta
+
+
+class JobScheduler:
+    """
+    Download slots with a global cap, per-service caps, priority classes and per-owner fairness.
+    Within a priority class owners (users) are served round-robin, i.e. deficit round robin with
+    unit job cost, and an owner never holds more than per_owner_limit slots at once.
+    A waiter blocked by its service cap or owner limit does not hold up anyone queued behind it.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_ALBUM = 1
+
+    def __init__(self, total, service_caps, per_owner_limit):
+        self.total = max(1, int(total))
+        self.service_caps = {k: max(1, int(v)) for k, v in (service_caps or {}).items()}
+        self.per_owner_limit = max(1, int(per_owner_limit))
+        self.active = 0
+        self.active_by_service = {}
+        self.active_by_owner = {}
+        # priority -> OrderedDict(owner -> deque of (service, future)); order is the round-robin turn
+        self._queues = {}
+        # priority -> [jobs, total wait, max wait]
+        self._wait_stats = {}
+
+    def _eligible(self, service, owner):
+        cap = self.service_caps.get(service, self.total)
+        return (
+            self.active < self.total
+            and self.active_by_service.get(service, 0) < cap
+            and self.active_by_owner.get(owner, 0) < self.per_owner_limit
+        )
+
+    def _take(self, service, owner):
+        self.active += 1
+        self.active_by_service[service] = self.active_by_service.get(service, 0) + 1
+        self.active_by_owner[owner] = self.active_by_owner.get(owner, 0) + 1
+
+    @staticmethod
+    def _decrement(counter, key):
+        left = counter.get(key, 1) - 1
+        if left > 0:
+            counter[key] = left
+        else:
+            counter.pop(key, None)
+
+    def _release(self, service, owner):
+        self.active -= 1
+        self._decrement(self.active_by_service, service)
+        self._decrement(self.active_by_owner, owner)
+        self._dispatch()
+
+    def _grant_one(self):
+        for priority in sorted(self._queues):
+            owners = self._queues[priority]
+            for owner in list(owners):
+                queue = owners[owner]
+                for entry in list(queue):
+                    service, fut = entry
+                    if fut.done():
+                        queue.remove(entry)
+                    elif self._eligible(service, owner):
+                        queue.remove(entry)
+                        self._take(service, owner)
+                        fut.set_result(True)
+                        # Served owner goes to the back of the rotation.
+                        owners.move_to_end(owner)
+                        if not queue:
+                            del owners[owner]
+                        return True
+                    else:
+                        # Owner limit blocks all of this owner's jobs; a service cap only this one.
+                        if self.active_by_owner.get(owner, 0) >= self.per_owner_limit:
+                            break
+                if not queue:
+                    owners.pop(owner, None)
+            if not owners:
+                del self._queues[priority]
+        return False
+
+    def _dispatch(self):
+        while self._grant_one():
+            pass
+
+    def queued(self):
+        return sum(len(q) for owners in self._queues.values() for q in owners.values())
+
+    def position(self, fut):
+        """Approximate 1-based place of a waiting job in the service order."""
+        ahead = 0
+        for priority in sorted(self._queues):
+            owners = self._queues[priority]
+            mine = None
+            for owner, queue in owners.items():
+                for idx, (_service, waiter) in enumerate(queue):
+                    if waiter is fut:
+                        mine = (owner, idx)
+            if mine is None:
+                ahead += sum(len(q) for q in owners.values())
+                continue
+            my_owner, my_idx = mine
+            before_me = True
+            for owner, queue in owners.items():
+                if owner == my_owner:
+                    before_me = False
+                    continue
+                # Each round serves one job per owner; owners earlier in the rotation go first.
+                ahead += min(len(queue), my_idx + 1 if before_me else my_idx)
+            return ahead + my_idx + 1
+        return 0
+
+    @asynccontextmanager
+    async def slot(self, service, owner, priority=PRIORITY_INTERACTIVE, on_queued=None):
+        """
+        Holds one slot for service on behalf of owner; yields the queue wait in seconds.
+        on_queued(position) is awaited when the job is queued and then at most every
+        QUEUE_POSITION_UPDATE_SEC while the position changes.
+        """
+        started = time.monotonic()
+        # After every dispatch no queued waiter is eligible, so a free slot can be taken directly.
+        if self._eligible(service, owner):
+            self._take(service, owner)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            owners = self._queues.setdefault(priority, OrderedDict())
+            owners.setdefault(owner, deque()).append((service, fut))
+            try:
+                last_position = None
+                while not fut.done():
+                    position = self.position(fut)
+                    if on_queued and position and position != last_position:
+                        last_position = position
+                        try:
+                            await on_queued(position)
+                        except Exception as e:
+                            logger.warning(f"Queue position update failed: {e}")
+                    if fut.done():
+                        break
+                    try:
+                        await asyncio.wait_for(asyncio.shield(fut), QUEUE_POSITION_UPDATE_SEC)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release(service, owner)
+                else:
+                    fut.cancel()
+                    self._dispatch()
+                raise
+        waited = time.monotonic() - started
+        stats = self._wait_stats.setdefault(priority, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        if waited >= SCHEDULER_WAIT_LOG_SEC:
+            logger.info(f"⏳ {service} job of {owner} waited {waited:.1f}s for a download slot (priority {priority}, queued {self.queued()})")
+        try:
+            yield waited
+        finally:
+            self._release(service, owner)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queued": self.queued(),
+            "by_service": dict(self.active_by_service),
+            "owners": len(self.active_by_owner),
+            "wait": {
+                priority: {"jobs": n, "avg_sec": round(total / n, 2) if n else 0.0, "max_sec": round(peak, 2)}
+                for priority, (n, total, peak) in list(self._wait_stats.items())
+            },
+        }
+
+
+def scheduler_service(detected_service, txt):
+    """Music links all download via ytsearch, so they share one scheduler bucket."""
+    if any(marker in (txt or "") for marker in MUSIC_MARKERS):
+        return "Music"
+    return detected_service
+
+
+class HttpClientRegistry:
+    """
+    Application-scoped aiohttp sessions: one pooled keep-alive session per proxy (None = direct).
+    Sessions share timeouts/limits from network.http; aiohttp only speaks HTTP(S) proxies.
+    """
+
+    PROXY_SCHEMES = ("http", "https")
+
+    def __init__(self):
+        self._sessions = {}
+
+    @classmethod
+    def proxy_supported(cls, proxy):
+        return not proxy or urlsplit(proxy).scheme.lower() in cls.PROXY_SCHEMES
+
+    def _new_session(self, proxy):
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL_SEC,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT_SEC,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SEC, sock_connect=HTTP_CONNECT_TIMEOUT_SEC),
+            proxy=proxy,
+        )
+
+    def session(self, proxy=None):
+        proxy = proxy or None
+        if not self.proxy_supported(proxy):
+            raise ValueError(f"aiohttp cannot use {urlsplit(proxy).scheme}:// proxies; configure an http(s) proxy")
+        sess = self._sessions.get(proxy)
+        if sess is None or sess.closed:
+            sess = self._new_session(proxy)
+            self._sessions[proxy] = sess
+        return sess
+
+    def start(self):
+        self.session()
+        # socks:// worked with requests (and still works for yt-dlp), but every aiohttp call through it fails.
+        checks = [("network.proxies.yandex", PROXIES.get("yandex"))]
+        if not INSTAGRAM_DIRECT_PARTS:
+            checks.append(("integrations.instagram.proxy", _instagram_proxy()))
+        for name, proxy in checks:
+            if not self.proxy_supported(proxy):
+                logger.error(
+                    f"❌ {name} uses {urlsplit(proxy).scheme}://, which aiohttp does not support; "
+                    f"HTTP requests through it will fail. Use an http(s) proxy."
+                )
+        logger.info(
+            f"🌐 HTTP client ready (pool {HTTP_POOL_LIMIT}, per host {HTTP_POOL_LIMIT_PER_HOST}, timeout {HTTP_TIMEOUT_SEC}s)"
+        )
+
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for sess in sessions:
+            if not sess.closed:
+                await sess.close()
+
+
+media_cache_lru = MediaCacheLRU(CACHE_LRU_SIZE, CACHE_TTL_SEC, CACHE_NEGATIVE_TTL_SEC)
+# short link -> expanded URL (TikTok vm./vt., Reddit /s/ shares)
+short_link_lru = MediaCacheLRU(CACHE_LRU_SIZE, SHORT_LINK_TTL_SEC, 0)
+# ym:track:/ym:album:/sp: content ID -> track metadata (backed by music_metadata)
+music_metadata_lru = MediaCacheLRU(CACHE_LRU_SIZE, MUSIC_METADATA_TTL_SEC, CACHE_NEGATIVE_TTL_SEC)
+log_writer = WriteBehindBuffer(LOG_FLUSH_BATCH_SIZE, LOG_FLUSH_INTERVAL_SEC)
+http_clients = HttpClientRegistry()
+download_scheduler = JobScheduler(DOWNLOAD_CONCURRENCY, SERVICE_CONCURRENCY, PER_USER_DOWNLOAD_CONCURRENCY)
+# user_id -> success_count as known to this process (DB value + queued increments); bounded, idle users age out
+private_success_counts = MediaCacheLRU(CACHE_LRU_SIZE, CACHE_TTL_SEC, 0)
 db_pool = None
 proxy_watchdog_task = None
+stats_task = None
 publisher_task = None
-shareable_media = {}
+log_writer_task = None
+db_maintenance_task = None
+db_pool_health_task = None
+ydl_process_pool = None
+ydl_info_cache = MediaCacheLRU(YTDLP_INFO_CACHE_SIZE, max(1, YTDLP_INFO_CACHE_TTL_SEC), 0)
+# _run_ydl runs in worker threads
+ydl_info_cache_lock = threading.Lock()
+# (cache key, variant) -> Future resolved with the owner's download outcome
+inflight_downloads = {}
+
+
+class ShareTokenStore:
+    """
+    Share tokens for the inline "Переслать" button.
+    An expiry-ordered heap keeps purging amortized O(log n); tokens are persisted to
+    share_tokens via the write-behind buffer and loaded lazily on lookup after a restart.
+    """
+
+    TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, ttl_sec):
+        self.ttl_sec = ttl_sec
+        self._items = {}
+        self._expiry = []
+        # Unknown/expired tokens, so repeated inline queries for them skip the DB
+        self._misses = MediaCacheLRU(CACHE_LRU_SIZE, max(1, CACHE_NEGATIVE_TTL_SEC), CACHE_NEGATIVE_TTL_SEC)
+
+    def _remember(self, token, item):
+        self._items[token] = item
+        heapq.heappush(self._expiry, (item["expires_at"], token))
+
+    def purge_expired(self):
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            _, token = heapq.heappop(self._expiry)
+            item = self._items.get(token)
+            if item and item["expires_at"] <= now:
+                self._items.pop(token, None)
+
+    def register(self, file_id, media_kind, caption=""):
+        self.purge_expired()
+        token = uuid.uuid4().hex
+        item = {
+            "file_id": file_id,
+            "media_kind": media_kind,
+            "caption": (caption or "")[:1024],
+            "expires_at": time.time() + self.ttl_sec,
+        }
+        self._remember(token, item)
+        if db_pool:
+            log_writer.add_share_token((
+                token, file_id, media_kind, item["caption"],
+                datetime.fromtimestamp(item["expires_at"], tz=timezone.utc),
+            ))
+        return token
+
+    async def lookup(self, token):
+        self.purge_expired()
+        item = self._items.get(token)
+        if item or not db_pool or not self.TOKEN_RE.match(token or ""):
+            return item
+        if self._misses.get(token) is not MediaCacheLRU.MISS:
+            return None
+        try:
+            async with db_pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    """
+                    SELECT file_id, media_kind, caption, expires_at
+                    FROM share_tokens
+                    WHERE token = $1 AND expires_at > CURRENT_TIMESTAMP
+                    """,
+                    token,
+                )
+        except Exception as e:
+            logger.warning(f"Share token lookup failed: {e}")
+            return None
+        if not row:
+            self._misses.put(token, None)
+            return None
+        item = {
+            "file_id": row["file_id"],
+            "media_kind": row["media_kind"],
+            "caption": row["caption"] or "",
+            "expires_at": row["expires_at"].timestamp(),
+        }
+        self._remember(token, item)
+        return item
+
+    async def purge_db(self):
+        if not db_pool:
+            return
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM share_tokens WHERE expires_at <= CURRENT_TIMESTAMP")
+        except Exception as e:
+            logger.warning(f"Share token purge failed: {e}")
 
 
-def purge_expired_share_tokens():
-    now = time.time()
-    expired = [token for token, item in shareable_media.items() if item.get("expires_at", 0) <= now]
-    for token in expired:
-        shareable_media.pop(token, None)
+share_tokens = ShareTokenStore(SHARE_TOKEN_TTL_SEC)
 
 
 def register_shareable_media(file_id, media_kind, caption=""):
     if media_kind not in {"video", "document"} or not file_id:
         return None
-    purge_expired_share_tokens()
-    token = uuid.uuid4().hex
-    shareable_media[token] = {
-        "file_id": file_id,
-        "media_kind": media_kind,
-        "caption": (caption or "")[:1024],
-        "expires_at": time.time() + SHARE_TOKEN_TTL_SEC,
-    }
-    return token
+    return share_tokens.register(file_id, media_kind, caption=caption)
 
 
 def build_share_keyboard(file_id, media_kind, caption=""):
@@ -389,58 +1091,349 @@ def _db_ssl_for_host(host):
     return ssl_ctx
 
 
+async def _claim_publish_batch(limit, lease_sec, max_attempts):
+    """
+    Leases up to `limit` unpublished rows and returns them. is_published is only set after
+    a successful send; a lease that is never confirmed (crash, failed send) expires and the
+    row is claimed again, up to max_attempts times. Rows that used up their attempts are
+    retired (is_published = TRUE) so they leave idx_requests_log_unpublished.
+    """
+    async with db_pool.acquire() as conn:
+        retired = await conn.execute(
+            """
+            UPDATE requests_log SET is_published = TRUE
+            WHERE is_published = FALSE
+              AND file_id IS NOT NULL
+              AND publish_attempts >= $2
+              AND publish_claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            """,
+            float(lease_sec), max_attempts,
+        )
+        if retired != "UPDATE 0":
+            logger.warning(f"⚠️ Publisher gave up on rows after {max_attempts} attempts: {retired}")
+        rows = await conn.fetch(
+            """
+            WITH claimed AS (
+                SELECT id
+                FROM requests_log
+                WHERE is_published = FALSE
+                  AND file_id IS NOT NULL
+                  AND service != 'Spotify'
+                  AND publish_attempts < $3
+                  AND (publish_claimed_at IS NULL
+                       OR publish_claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $2))
+                ORDER BY id ASC
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE requests_log AS r
+            SET publish_claimed_at = CURRENT_TIMESTAMP,
+                publish_attempts = r.publish_attempts + 1
+            FROM claimed
+            WHERE r.id = claimed.id
+            RETURNING r.id, r.file_id, r.media_kind, r.publish_attempts
+            """,
+            limit, float(lease_sec), max_attempts,
+        )
+    return sorted(rows, key=lambda r: r["id"])
+
+
+async def _mark_published(row_id):
+    async with db_pool.acquire() as conn:
+        await conn.execute("UPDATE requests_log SET is_published = TRUE WHERE id = $1", row_id)
+
+
+async def _publish_file(app, chat_id, file_id, media_kind):
+    if media_kind:
+        await send_cached_media(app, chat_id, file_id, media_kind=media_kind)
+        return
+    # Rows logged before media_kind existed.
+    try:
+        await app.bot.send_video(chat_id=chat_id, video=file_id)
+    except Exception:
+        await app.bot.send_audio(chat_id=chat_id, audio=file_id)
+
+
 async def publisher_loop(app):
     chat_id = cfg("features.publisher.chat_id", "@jgCache")
     delay_sec = int(cfg("features.publisher.delay_sec", 60))
     idle_sec = int(cfg("features.publisher.idle_sec", 60))
+    batch_size = max(1, int(cfg("features.publisher.batch_size", 10)))
+    max_attempts = max(1, int(cfg("features.publisher.max_attempts", 3)))
+    # The lease must outlive a full batch of sends and delays.
+    lease_sec = max(int(cfg("features.publisher.lease_sec", 0) or 0), batch_size * (delay_sec + 30))
     while True:
         if not db_pool:
             await asyncio.sleep(idle_sec)
             continue
         try:
-            async with db_pool.acquire() as conn:
-                row = await conn.fetchrow(
-                    """
-                    SELECT id, file_id, link
-                    FROM requests_log
-                    WHERE file_id IS NOT NULL
-                      AND is_published = FALSE
-                      AND service != 'Spotify'
-                    ORDER BY id ASC
-                    LIMIT 1
-                    """
-                )
-            if not row:
+            # SKIP LOCKED plus the lease keeps instances apart; a bad file_id
+            # is retried only max_attempts times, so it cannot stall the queue.
+            rows = await _claim_publish_batch(batch_size, lease_sec, max_attempts)
+            if not rows:
                 await asyncio.sleep(idle_sec)
                 continue
 
-            sent = False
-            try:
-                await app.bot.send_video(chat_id=chat_id, video=row["file_id"])
-                sent = True
-            except Exception:
+            for row in rows:
                 try:
-                    await app.bot.send_audio(chat_id=chat_id, audio=row["file_id"])
-                    sent = True
+                    await _publish_file(app, chat_id, row["file_id"], row["media_kind"])
                 except Exception as send_err:
-                    logger.error(f"⚠️ Publisher send error: {send_err}")
-
-            if sent:
-                async with db_pool.acquire() as conn:
-                    await conn.execute(
-                        "UPDATE requests_log SET is_published = TRUE WHERE id = $1",
-                        row["id"],
-                    )
+                    logger.error(f"⚠️ Publisher send error (id={row['id']}): {send_err}")
+                    if row["publish_attempts"] >= max_attempts:
+                        # Last attempt: retire the row instead of leaving it in the unpublished index.
+                        await _mark_published(row["id"])
+                    continue
+                await _mark_published(row["id"])
                 await asyncio.sleep(delay_sec)
-            else:
-                await asyncio.sleep(idle_sec)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"⚠️ Publisher loop error: {e}")
             await asyncio.sleep(idle_sec)
 
+def _month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def _add_months(dt, months):
+    year, month = divmod(dt.month - 1 + months, 12)
+    return datetime(dt.year + year, month + 1, 1)
+
+
+def _requests_log_partition_name(month):
+    return f"requests_log_p{month:%Y%m}"
+
+
+async def _db_current_month(conn):
+    """Start of the current month as created_at (server-side CURRENT_TIMESTAMP) sees it."""
+    return _month_start(await conn.fetchval("SELECT date_trunc('month', LOCALTIMESTAMP)"))
+
+
+async def _create_requests_log_partition(conn, month):
+    """
+    Creates the partition for month. Rows for that month already sitting in the
+    default partition are moved into it first, otherwise attaching would fail forever.
+    """
+    name = _requests_log_partition_name(month)
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name):
+        return
+    start, end = month, _add_months(month, 1)
+    columns = "id, user_id, username, chat_id, link, service, file_id, media_kind, is_published, created_at"
+    try:
+        async with conn.transaction():
+            await conn.execute(f"CREATE TABLE {name} (LIKE requests_log INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            moved = await conn.execute(
+                f"""
+                WITH moved AS (
+                    DELETE FROM requests_log_default
+                    WHERE created_at >= $1 AND created_at < $2
+                    RETURNING {columns}
+                )
+                INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+                """,
+                start, end,
+                timeout=DB_MIGRATION_TIMEOUT_SEC,
+            )
+            await conn.execute(
+                f"ALTER TABLE requests_log ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            )
+        if moved != "INSERT 0 0":
+            logger.info(f"🗂 Moved default-partition rows into {name}: {moved}")
+    except Exception as e:
+        logger.warning(f"⚠️ Could not create partition {name}: {e}")
+
+
+async def migrate_requests_log(conn):
+    """
+    Ensures requests_log is range-partitioned by month on created_at.
+    A legacy plain table is converted once, in a single transaction, keeping only rows within retention.
+    """
+    relkind = await conn.fetchval(
+        """
+        SELECT c.relkind::text
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = 'requests_log' AND n.nspname = current_schema()
+        """
+    )
+    if relkind == "p":
+        return
+
+    ddl = '''
+        CREATE TABLE requests_log (
+            id BIGSERIAL,
+            user_id BIGINT,
+            username TEXT,
+            chat_id BIGINT,
+            link TEXT,
+            service TEXT,
+            file_id TEXT,
+            media_kind TEXT,
+            is_published BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        CREATE TABLE requests_log_default PARTITION OF requests_log DEFAULT;
+    '''
+    current_month = await _db_current_month(conn)
+    if relkind is None:
+        await conn.execute(ddl)
+        for i in range(REQUESTS_LOG_PARTITIONS_AHEAD + 1):
+            await _create_requests_log_partition(conn, _add_months(current_month, i))
+        logger.info("🗂 Created partitioned requests_log.")
+        return
+
+    logger.info("🗂 Converting requests_log to a partitioned table (one-time)...")
+    await conn.execute("ALTER TABLE requests_log ADD COLUMN IF NOT EXISTS media_kind TEXT")
+    # Derived tables are filled from the full legacy history before retention applies.
+    await backfill_media_cache(conn)
+    await backfill_request_rollups(conn)
+
+    cutoff = _add_months(current_month, -REQUESTS_LOG_RETENTION_MONTHS) if REQUESTS_LOG_RETENTION_MONTHS else datetime(1970, 1, 1)
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE requests_log RENAME TO requests_log_legacy")
+        await conn.execute("ALTER INDEX IF EXISTS requests_log_pkey RENAME TO requests_log_legacy_pkey")
+        await conn.execute(ddl)
+        oldest = await conn.fetchval(
+            "SELECT min(created_at) FROM requests_log_legacy WHERE created_at >= $1", cutoff
+        )
+        month = _month_start(oldest) if oldest else current_month
+        while month <= _add_months(current_month, REQUESTS_LOG_PARTITIONS_AHEAD):
+            await _create_requests_log_partition(conn, month)
+            month = _add_months(month, 1)
+        # Copied in id ranges so no single statement scans the whole legacy table.
+        copied = 0
+        low, high = await conn.fetchrow("SELECT min(id), max(id) FROM requests_log_legacy")
+        while low is not None and low <= high:
+            result = await conn.execute(
+                """
+                INSERT INTO requests_log
+                    (id, user_id, username, chat_id, link, service, file_id, media_kind, is_published, created_at)
+                SELECT
+                    id, user_id, username, chat_id, link, service, file_id, media_kind,
+                    COALESCE(is_published, FALSE), COALESCE(created_at, CURRENT_TIMESTAMP)
+                FROM requests_log_legacy
+                WHERE id >= $2 AND id < $3 AND (created_at IS NULL OR created_at >= $1)
+                """,
+                cutoff, low, low + REQUESTS_LOG_MIGRATION_BATCH,
+                timeout=DB_MIGRATION_TIMEOUT_SEC,
+            )
+            copied += int(result.split()[-1])
+            low += REQUESTS_LOG_MIGRATION_BATCH
+        await conn.execute(
+            "SELECT setval(pg_get_serial_sequence('requests_log', 'id'), "
+            "GREATEST((SELECT max(id) FROM requests_log), 1))"
+        )
+        await conn.execute("DROP TABLE requests_log_legacy")
+    logger.info(f"🗂 requests_log partitioned: {copied} rows copied")
+
+
+async def maintain_requests_log_partitions(conn):
+    """Creates upcoming monthly partitions and drops those past the retention window."""
+    current_month = await _db_current_month(conn)
+    for i in range(REQUESTS_LOG_PARTITIONS_AHEAD + 1):
+        await _create_requests_log_partition(conn, _add_months(current_month, i))
+
+    if not REQUESTS_LOG_RETENTION_MONTHS:
+        return
+    cutoff = _add_months(current_month, -REQUESTS_LOG_RETENTION_MONTHS)
+    rows = await conn.fetch(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'requests_log'::regclass
+        """
+    )
+    for row in rows:
+        match = re.fullmatch(r"requests_log_p(\d{4})(\d{2})", row["relname"])
+        if match and datetime(int(match.group(1)), int(match.group(2)), 1) < cutoff:
+            await conn.execute(f"DROP TABLE IF EXISTS {row['relname']}")
+            logger.info(f"🧹 Dropped requests_log partition {row['relname']} (retention {REQUESTS_LOG_RETENTION_MONTHS} months)")
+    await conn.execute("DELETE FROM requests_log_default WHERE created_at < $1", cutoff)
+
+
+async def backfill_request_rollups(conn):
+    """One-time fill of the rollup tables from requests_log."""
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM chat_rollup)"):
+        return
+    async with conn.transaction():
+        await conn.execute(
+            """
+            INSERT INTO requests_daily_rollup (day, service, requests)
+            SELECT created_at::date, COALESCE(service, 'Unknown'), count(*)
+            FROM requests_log
+            WHERE created_at IS NOT NULL
+            GROUP BY 1, 2
+            ON CONFLICT (day, service) DO NOTHING
+            """,
+            timeout=DB_MIGRATION_TIMEOUT_SEC,
+        )
+        for table, column in (("chat_rollup", "chat_id"), ("user_rollup", "user_id")):
+            await conn.execute(
+                f"""
+                INSERT INTO {table} ({column}, requests, first_seen_at, last_seen_at)
+                SELECT {column}, count(*), min(created_at), max(created_at)
+                FROM requests_log
+                WHERE {column} IS NOT NULL
+                GROUP BY {column}
+                ON CONFLICT ({column}) DO NOTHING
+                """,
+                timeout=DB_MIGRATION_TIMEOUT_SEC,
+            )
+    logger.info("🗂 Rollup tables backfilled from requests_log.")
+
+
+async def db_maintenance_loop():
+    while True:
+        try:
+            await share_tokens.purge_db()
+            if db_pool:
+                async with db_pool.acquire() as conn:
+                    await maintain_requests_log_partitions(conn)
+                    await conn.execute("DELETE FROM music_metadata WHERE expires_at <= CURRENT_TIMESTAMP")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"DB maintenance loop error: {e}")
+        await asyncio.sleep(CLEANUP_INTERVAL_SEC)
+
+async def db_pool_health_loop():
+    """Periodic probe: acquire wait, round-trip and pool occupancy."""
+    while True:
+        await asyncio.sleep(DB_POOL_HEALTH_INTERVAL_SEC)
+        pool = db_pool
+        if not pool:
+            continue
+        try:
+            started = time.monotonic()
+            async with pool.acquire() as conn:
+                acquired = time.monotonic()
+                await conn.fetchval("SELECT 1")
+            acquire_ms = (acquired - started) * 1000
+            query_ms = (time.monotonic() - acquired) * 1000
+            size, idle = pool.get_size(), pool.get_idle_size()
+            summary = (
+                f"acquire {acquire_ms:.1f}ms, query {query_ms:.1f}ms, "
+                f"in use {size - idle}/{pool.get_max_size()}, idle {idle}, pending writes {log_writer.pending()}"
+            )
+            if acquire_ms >= DB_POOL_ACQUIRE_WARN_MS:
+                logger.warning(f"🐢 DB pool saturated: {summary}")
+            else:
+                logger.info(f"🩺 DB pool: {summary}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ DB pool health probe failed: {e}")
+
+
 async def init_db(app):
     """Connect to DB and create table on startup"""
-    global db_pool, proxy_watchdog_task, publisher_task
+    global db_pool, proxy_watchdog_task, publisher_task, log_writer_task, db_maintenance_task, db_pool_health_task, stats_task
+    http_clients.start()
+    if stats_task is None or stats_task.done():
+        stats_task = asyncio.create_task(stats_log_loop())
     if proxy_watchdog_task is None or proxy_watchdog_task.done():
         proxy_watchdog_task = asyncio.create_task(proxy_watchdog_loop(app))
         logger.info("🕛 Proxy watchdog started (daily at 00:00 server time).")
@@ -455,88 +1448,189 @@ async def init_db(app):
         dsn = f"postgresql://{DB_CONFIG['USER']}:{DB_CONFIG['PASSWORD']}@{DB_CONFIG['HOST']}:{DB_CONFIG['PORT']}/{DB_CONFIG['DB_NAME']}"
         logger.info(f"🔌 Connecting to DB: {DB_CONFIG['HOST']}...")
         
-        db_pool = await asyncpg.create_pool(dsn, ssl=_db_ssl_for_host(DB_CONFIG.get("HOST")))
+        db_pool = await asyncpg.create_pool(
+            dsn,
+            ssl=_db_ssl_for_host(DB_CONFIG.get("HOST")),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT_SEC,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME_SEC,
+        )
+        logger.info(
+            f"🔌 DB pool ready (size {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE}, statement cache {DB_STATEMENT_CACHE_SIZE})"
+        )
         
         async with db_pool.acquire() as conn:
             await conn.execute('''
-                CREATE TABLE IF NOT EXISTS requests_log (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    username TEXT,
-                    chat_id BIGINT,
-                    link TEXT,
-                    service TEXT,
-                    file_id TEXT,
-                    is_published BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                CREATE INDEX IF NOT EXISTS idx_user_id ON requests_log(user_id);
-                CREATE INDEX IF NOT EXISTS idx_link ON requests_log(link);
                 CREATE TABLE IF NOT EXISTS user_private_media_stats (
                     user_id BIGINT PRIMARY KEY,
                     success_count INTEGER NOT NULL DEFAULT 0,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    cache_key TEXT NOT NULL,
+                    variant TEXT NOT NULL DEFAULT 'media',
+                    file_id TEXT NOT NULL,
+                    media_kind TEXT,
+                    file_size BIGINT,
+                    service TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (cache_key, variant)
+                );
+                CREATE TABLE IF NOT EXISTS share_tokens (
+                    token TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    media_kind TEXT NOT NULL,
+                    caption TEXT,
+                    expires_at TIMESTAMPTZ NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_share_tokens_expires_at ON share_tokens(expires_at);
+                CREATE TABLE IF NOT EXISTS music_metadata (
+                    content_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    expires_at TIMESTAMPTZ NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS requests_daily_rollup (
+                    day DATE NOT NULL,
+                    service TEXT NOT NULL,
+                    requests BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, service)
+                );
+                CREATE TABLE IF NOT EXISTS chat_rollup (
+                    chat_id BIGINT PRIMARY KEY,
+                    requests BIGINT NOT NULL DEFAULT 0,
+                    first_seen_at TIMESTAMP,
+                    last_seen_at TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS user_rollup (
+                    user_id BIGINT PRIMARY KEY,
+                    requests BIGINT NOT NULL DEFAULT 0,
+                    first_seen_at TIMESTAMP,
+                    last_seen_at TIMESTAMP
+                );
             ''')
+            await migrate_requests_log(conn)
+            await conn.execute('''
+                ALTER TABLE requests_log ADD COLUMN IF NOT EXISTS media_kind TEXT;
+                ALTER TABLE requests_log ADD COLUMN IF NOT EXISTS publish_claimed_at TIMESTAMPTZ;
+                ALTER TABLE requests_log ADD COLUMN IF NOT EXISTS publish_attempts SMALLINT NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS idx_user_id ON requests_log(user_id);
+                CREATE INDEX IF NOT EXISTS idx_link ON requests_log(link);
+                CREATE INDEX IF NOT EXISTS idx_requests_log_unpublished
+                    ON requests_log(id) WHERE is_published = FALSE AND file_id IS NOT NULL;
+            ''')
+            await backfill_media_cache(conn)
+            await backfill_request_rollups(conn)
+            await maintain_requests_log_partitions(conn)
             
         logger.info("✅ Database connected and schema ready.")
+    except Exception as e:
+        logger.error(f"❌ Database Init Error: {e}")
+
+    # A failed migration/backfill still leaves a usable pool; the writers must run either way.
+    if db_pool:
+        if log_writer_task is None or log_writer_task.done():
+            log_writer_task = asyncio.create_task(log_writer.run())
+        if db_maintenance_task is None or db_maintenance_task.done():
+            db_maintenance_task = asyncio.create_task(db_maintenance_loop())
+        if db_pool_health_task is None or db_pool_health_task.done():
+            db_pool_health_task = asyncio.create_task(db_pool_health_loop())
         if cfg("features.publisher.enabled", True):
             if publisher_task is None or publisher_task.done():
                 publisher_task = asyncio.create_task(publisher_loop(app))
                 logger.info("📤 Built-in publisher loop started.")
-    except Exception as e:
-        logger.error(f"❌ Database Init Error: {e}")
 
-async def save_log(user_id, username, chat_id, link, service, file_id=None):
-    """Save request to DB"""
+async def backfill_media_cache(conn):
+    """One-time fill of media_cache from the latest file_id per link in requests_log."""
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM media_cache)"):
+        return
+    result = await conn.execute(
+        """
+        INSERT INTO media_cache (cache_key, variant, file_id, media_kind, service, created_at, last_hit_at)
+        SELECT DISTINCT ON (link)
+            link,
+            CASE WHEN is_audio THEN 'audio' ELSE 'media' END,
+            file_id,
+            CASE WHEN is_audio THEN 'audio' END,
+            service,
+            created_at,
+            created_at
+        FROM (
+            SELECT
+                id, link, file_id, service, created_at,
+                (link LIKE '%music.yandex%' OR link LIKE '%spotify%' OR link LIKE '%music.youtube%') AS is_audio
+            FROM requests_log
+            WHERE file_id IS NOT NULL AND link IS NOT NULL
+        ) AS log_rows
+        ORDER BY link, (service = 'Cached_Media'), id DESC
+        ON CONFLICT (cache_key, variant) DO NOTHING
+        """,
+        timeout=DB_MIGRATION_TIMEOUT_SEC,
+    )
+    logger.info(f"🗂 media_cache backfill from requests_log: {result}")
+
+
+async def shutdown_db(app):
+    """Final write-behind flush, then close the DB pool, yt-dlp workers and HTTP session"""
+    global db_pool
+    for task in (log_writer_task, db_maintenance_task, db_pool_health_task, stats_task):
+        if task and not task.done():
+            task.cancel()
+    if log_writer.pending():
+        logger.info(f"💾 Flushing {log_writer.pending()} pending DB writes before shutdown...")
+    await log_writer.flush()
+    if db_pool:
+        await db_pool.close()
+        db_pool = None
+    if ydl_process_pool:
+        ydl_process_pool.shutdown(wait=False, cancel_futures=True)
+    await http_clients.close()
+
+
+async def save_log(user_id, username, chat_id, link, service, file_id=None, media_kind=None):
+    """Queue request row for the batched requests_log writer"""
     if not db_pool: return
-    try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                '''INSERT INTO requests_log (user_id, username, chat_id, link, service, file_id) 
-                   VALUES ($1, $2, $3, $4, $5, $6)''',
-                user_id, username, chat_id, link, service, file_id
-            )
-        logger.info(f"📝 Logged: {username} -> {service}")
-    except Exception as e:
-        logger.error(f"⚠️ Log Error: {e}")
+    log_writer.add_log((user_id, username, chat_id, link, service, file_id, media_kind))
+    logger.info(f"📝 Logged: {username} -> {service}")
 
 
 async def increment_private_media_success(user_id):
     if not db_pool or not user_id:
         return None
-    try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                INSERT INTO user_private_media_stats (user_id, success_count, updated_at)
-                VALUES ($1, 1, CURRENT_TIMESTAMP)
-                ON CONFLICT (user_id)
-                DO UPDATE SET
-                    success_count = user_private_media_stats.success_count + 1,
-                    updated_at = CURRENT_TIMESTAMP
-                RETURNING success_count
-                """,
-                user_id,
-            )
-        return int(row["success_count"]) if row else None
-    except Exception as e:
-        logger.error(f"⚠️ Failed to update private media stats for {user_id}: {e}")
-        return None
+    count = private_success_counts.get(user_id)
+    if count is MediaCacheLRU.MISS:
+        # Read the stored total when the user is not cached; later increments are counted locally.
+        try:
+            async with db_pool.acquire() as conn:
+                stored = await conn.fetchval(
+                    "SELECT success_count FROM user_private_media_stats WHERE user_id = $1",
+                    user_id,
+                )
+        except Exception as e:
+            logger.error(f"⚠️ Failed to read private media stats for {user_id}: {e}")
+            return None
+        # Increments still queued in the write-behind buffer are not in the DB yet.
+        count = int(stored or 0) + log_writer.private_success.get(user_id, 0)
+    count += 1
+    private_success_counts.put(user_id, count)
+    log_writer.add_private_success(user_id)
+    return count
 
 
 def yookassa_enabled():
     return bool(YOO_SHOP_ID and YOO_SECRET_KEY)
 
 
-def create_yookassa_donation(amount_rub, user_id):
+async def create_yookassa_donation(amount_rub, user_id):
     receipt_contact = YOO_RECEIPT_FALLBACK_EMAIL
     customer = {"email": receipt_contact}
     headers = {
         "Idempotence-Key": str(uuid.uuid4()),
         "Content-Type": "application/json",
     }
-    auth = (YOO_SHOP_ID, YOO_SECRET_KEY)
+    auth = aiohttp.BasicAuth(str(YOO_SHOP_ID), str(YOO_SECRET_KEY))
     payload = {
         "amount": {"value": f"{int(amount_rub)}.00", "currency": "RUB"},
         "capture": True,
@@ -558,11 +1652,13 @@ def create_yookassa_donation(amount_rub, user_id):
             ],
         },
     }
-    response = requests.post(YOO_API_URL, json=payload, auth=auth, headers=headers, timeout=20)
-    raw = response.text or ""
-    if response.status_code not in {200, 201}:
-        raise RuntimeError(f"YooKassa {response.status_code}: {raw[:300]}")
-    data = response.json()
+    async with http_clients.session().post(
+        YOO_API_URL, json=payload, auth=auth, headers=headers, timeout=aiohttp.ClientTimeout(total=20)
+    ) as response:
+        raw = await response.text()
+        if response.status not in {200, 201}:
+            raise RuntimeError(f"YooKassa {response.status}: {raw[:300]}")
+    data = json.loads(raw)
     confirmation = data.get("confirmation") or {}
     confirmation_url = str(confirmation.get("confirmation_url") or "").strip()
     if not confirmation_url:
@@ -599,30 +1695,238 @@ async def maybe_send_donation_prompt(context, chat, user):
     except Exception as e:
         logger.warning(f"Failed to send donation prompt to {chat.id}: {e}")
 
-async def check_db_cache(link):
-    """Check DB cache (returns file_id or None)"""
-    if not db_pool: return None
+def media_cache_variant(text):
+    """Music links are delivered as audio; everything else as the downloaded media."""
+    return "audio" if any(x in (text or "") for x in MUSIC_MARKERS) else "media"
+
+
+async def check_db_cache(link, variant="media"):
+    """Check cache (returns {"file_id", "media_kind"} or None)"""
+    return (await check_db_cache_any([link], variant))[1]
+
+
+async def check_db_cache_any(keys, variant="media"):
+    """
+    First cached entry among keys (in priority order) as (key, {"file_id", "media_kind"}),
+    or (None, None). Keys missing from the LRU are looked up in a single statement.
+    """
+    keys = [k for k in dict.fromkeys(keys) if k]
+    missing = []
+    for key in keys:
+        cached = media_cache_lru.get((key, variant))
+        if cached is MediaCacheLRU.MISS:
+            missing.append(key)
+        elif cached:
+            return key, cached
+    if not missing or not db_pool:
+        return None, None
     try:
         async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT file_id FROM requests_log WHERE link = $1 AND file_id IS NOT NULL ORDER BY id DESC LIMIT 1",
-                link
-            )
-            return row['file_id'] if row else None
+            rows = await conn.fetch(SQL_MEDIA_CACHE_LOOKUP_ANY, missing, variant)
     except Exception as e:
         logger.error(f"⚠️ DB Cache Error: {e}")
-        return None
+        return None, None
+    found = {row['cache_key']: {"file_id": row['file_id'], "media_kind": row['media_kind']} for row in rows}
+    for key in missing:
+        media_cache_lru.put((key, variant), found.get(key))
+    for key in missing:
+        if key in found:
+            return key, found[key]
+    return None, None
+
+
+def _is_tiktok_short_url(url):
+    try:
+        host = (urlsplit(url or "").hostname or "").lower()
+        return host in {"vm.tiktok.com", "vt.tiktok.com"}
+    except Exception:
+        return False
+
+
+async def _expand_tiktok_short_url(url):
+    cached = short_link_lru.get(url)
+    if cached is not MediaCacheLRU.MISS:
+        return cached
+    try:
+        timeout = aiohttp.ClientTimeout(total=SHORT_LINK_RESOLVE_TIMEOUT_SEC)
+        async with http_clients.session().head(
+            url, allow_redirects=False, headers={"User-Agent": "Mozilla/5.0"}, timeout=timeout
+        ) as resp:
+            location = resp.headers.get("Location")
+    except Exception as e:
+        logger.warning(f"TikTok short link resolve failed: {e}")
+        return url
+    target = urljoin(url, location) if location else url
+    short_link_lru.put(url, target)
+    return target
+
+
+def needs_cache_key_expansion(link):
+    """Short/share links whose content ID is only known after following a redirect."""
+    return not canonical_content_id(link) and (_is_tiktok_short_url(link) or _is_reddit_share_url(link))
+
+
+async def resolve_cache_key(link):
+    """Cache key for a link: platform content ID when known, normalized link otherwise."""
+    content_id = canonical_content_id(link)
+    if content_id:
+        return content_id
+    expanded = None
+    if _is_tiktok_short_url(link):
+        expanded = await _expand_tiktok_short_url(link)
+    elif _is_reddit_share_url(link):
+        expanded = await resolve_reddit_share_url(link, REDDIT_CONFIG.get("proxy") or PROXIES.get("reddit"))
+    if expanded and expanded != link:
+        content_id = canonical_content_id(expanded)
+        if content_id:
+            return content_id
+    return normalize_link_for_cache(link)
+
+
+async def remember_media_kind(link, variant, file_id, media_kind):
+    """Store a media kind learned by probing a legacy entry, so later hits dispatch directly."""
+    media_cache_lru.put((link, variant), {"file_id": file_id, "media_kind": media_kind})
+    if not db_pool: return
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE media_cache SET media_kind = $4
+                WHERE cache_key = $1 AND variant = $2 AND file_id = $3 AND media_kind IS NULL
+                """,
+                link, variant, file_id, media_kind
+            )
+    except Exception as e:
+        logger.warning(f"Failed to store media kind for {link}: {e}")
+
+
+async def delete_media_cache(link, variant):
+    """Drop a file_id Telegram no longer accepts, so the next request downloads again."""
+    media_cache_lru.invalidate((link, variant))
+    if not link or not db_pool: return
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("DELETE FROM media_cache WHERE cache_key = $1 AND variant = $2", link, variant)
+    except Exception as e:
+        logger.error(f"⚠️ Media cache delete error: {e}")
+
+
+async def upsert_media_cache(link, variant, file_id, media_kind, service, file_size=None):
+    """Record a delivered file_id for link/variant (LRU + media_cache)."""
+    if not link or not file_id:
+        return
+    media_cache_lru.put((link, variant), {"file_id": file_id, "media_kind": media_kind})
+    if not db_pool: return
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute(SQL_MEDIA_CACHE_UPSERT, link, variant, file_id, media_kind, file_size, service)
+    except Exception as e:
+        logger.error(f"⚠️ Media cache save error: {e}")
 
 def cleanup_loop():
     while True:
         time.sleep(CLEANUP_INTERVAL_SEC)
-        purge_expired_share_tokens()
-        now = time.time()
-        for f in os.listdir(BASE_DIR):
-            if f.endswith(('.mp3', '.mp4', '.part', '.webm', '.jpg', '.png', '.ogg')):
-                if now - os.path.getmtime(os.path.join(BASE_DIR, f)) > CLEANUP_TTL_SEC:
-                    try: os.remove(os.path.join(BASE_DIR, f))
-                    except: pass
+        try:
+            now = time.time()
+            for f in os.listdir(BASE_DIR):
+                if f.endswith(('.mp3', '.m4a', '.mp4', '.part', '.webm', '.jpg', '.png', '.ogg')):
+                    if now - os.path.getmtime(os.path.join(BASE_DIR, f)) > CLEANUP_TTL_SEC:
+                        try: os.remove(os.path.join(BASE_DIR, f))
+                        except: pass
+        except Exception as e:
+            logger.error(f"Cleanup loop error: {e}")
+
+
+async def stats_log_loop():
+    """Cache/scheduler stats; runs on the event loop, which owns (and mutates) those structures."""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_SEC)
+        try:
+            logger.info("📊 Media cache stats: %s", media_cache_lru.stats())
+            logger.info("📊 Download scheduler stats: %s", download_scheduler.stats())
+        except Exception as e:
+            logger.error(f"Stats logging error: {e}")
+
+
+class ProcessResult:
+    """Outcome of run_process(); stdout/stderr are decoded text, stderr keeps only the tail."""
+
+    def __init__(self, returncode, stdout, stderr, timed_out, elapsed, cpu_sec):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+        self.cpu_sec = cpu_sec
+
+
+async def _read_stream_tail(stream, limit):
+    buf = bytearray()
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return bytes(buf)
+        buf += chunk
+        if limit and len(buf) > limit:
+            del buf[:len(buf) - limit]
+
+
+def _kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run_process(cmd, timeout=None, capture_stdout=False, label=None):
+    """
+    Runs cmd without blocking a worker thread.
+    The child gets its own process group, killed on timeout or cancellation (covers helper scripts' children).
+    CPU time is the RUSAGE_CHILDREN delta, so it is approximate while other children finish concurrently.
+    """
+    label = label or os.path.basename(cmd[0])
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    readers = [asyncio.create_task(_read_stream_tail(proc.stderr, PROCESS_STDERR_LIMIT_BYTES))]
+    if capture_stdout:
+        readers.append(asyncio.create_task(_read_stream_tail(proc.stdout, 0)))
+    waiter = asyncio.gather(proc.wait(), *readers)
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logger.warning(f"⏱ {label} exceeded {timeout}s, killing pid {proc.pid}")
+        _kill_process_group(proc)
+        await waiter
+    except asyncio.CancelledError:
+        # The killed child still gets reaped by the waiter; only its result is dropped.
+        _kill_process_group(proc)
+        waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+    outputs = [reader.result() for reader in readers]
+    elapsed = time.monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_sec = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    stderr = outputs[0].decode(errors="ignore")
+    if timed_out:
+        stderr = f"{stderr}\n{label} timed out after {timeout}s".strip()
+    logger.info(f"⚙️ {label}: rc={proc.returncode} wall={elapsed:.1f}s cpu≈{cpu_sec:.1f}s")
+    return ProcessResult(
+        proc.returncode,
+        outputs[1].decode(errors="ignore") if capture_stdout else "",
+        stderr,
+        timed_out,
+        elapsed,
+        cpu_sec,
+    )
 
 
 def _is_reddit_share_url(url):
@@ -635,7 +1939,7 @@ def _is_reddit_share_url(url):
         return False
 
 
-def _resolve_reddit_share_url_sync(url, proxy):
+async def _resolve_reddit_share_url_curl(url, proxy):
     cmds = [
         ["curl", "-sS", "-m", str(REDDIT_SHORT_RESOLVE_TIMEOUT_SEC), "-I", url],
         ["curl", "-sS", "-m", str(REDDIT_SHORT_RESOLVE_TIMEOUT_SEC), "-o", "/dev/null", "-D", "-", url],
@@ -643,7 +1947,9 @@ def _resolve_reddit_share_url_sync(url, proxy):
     for cmd in cmds:
         if proxy:
             cmd.extend(["--proxy", proxy])
-        proc = subprocess.run(cmd, capture_output=True, text=True)
+        proc = await run_process(
+            cmd, timeout=REDDIT_SHORT_RESOLVE_TIMEOUT_SEC + 5, capture_stdout=True, label="curl reddit share"
+        )
         if proc.returncode != 0:
             continue
         for line in (proc.stdout or "").splitlines():
@@ -657,10 +1963,14 @@ def _resolve_reddit_share_url_sync(url, proxy):
 async def resolve_reddit_share_url(url, proxy):
     if not _is_reddit_share_url(url):
         return url
+    cached = short_link_lru.get(url)
+    if cached is not MediaCacheLRU.MISS:
+        return cached
     try:
-        resolved = await asyncio.to_thread(_resolve_reddit_share_url_sync, url, proxy)
+        resolved = await _resolve_reddit_share_url_curl(url, proxy)
         if resolved and resolved != url:
             logger.info(f"🔁 Resolved Reddit share URL: {url} -> {resolved}")
+            short_link_lru.put(url, resolved)
             return resolved
     except Exception as e:
         logger.warning(f"Reddit share resolve failed: {e}")
@@ -703,6 +2013,9 @@ def _collect_proxy_sources():
     reddit_proxy = REDDIT_CONFIG.get("proxy")
     if isinstance(reddit_proxy, str) and reddit_proxy.strip():
         items.append(("integrations.reddit.proxy", reddit_proxy.strip()))
+    configured_instagram_proxy = INSTAGRAM_CONFIG.get("proxy")
+    if isinstance(configured_instagram_proxy, str) and configured_instagram_proxy.strip():
+        items.append(("integrations.instagram.proxy", configured_instagram_proxy.strip()))
     instagram_proxy = _extract_instagram_helper_proxy()
     if isinstance(instagram_proxy, str) and instagram_proxy.strip():
         items.append(("integrations.instagram.helper_script", instagram_proxy.strip()))
@@ -778,20 +2091,24 @@ def _proxy6_item_as_url(item, scheme_override=None):
     return f"{scheme}://{host}:{port}"
 
 
-def _proxy6_call_sync(method, params=None):
+async def _proxy6_call(method, params=None):
     if not PROXY6_API_KEY:
         raise Proxy6APIError("Proxy6 API key is not configured.")
 
     url = f"{PROXY6_API_BASE_URL.rstrip('/')}/{PROXY6_API_KEY}/{method.lstrip('/')}"
     try:
-        response = requests.get(url, params=params or {}, timeout=PROXY6_TIMEOUT_SEC)
-    except requests.RequestException as e:
+        async with http_clients.session().get(
+            url, params={k: str(v) for k, v in (params or {}).items()}, timeout=aiohttp.ClientTimeout(total=PROXY6_TIMEOUT_SEC)
+        ) as response:
+            status = response.status
+            body = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         raise Proxy6APIError(f"Proxy6 request failed: {e}") from e
 
     try:
-        payload = response.json()
+        payload = json.loads(body)
     except ValueError as e:
-        raise Proxy6APIError(f"Proxy6 invalid JSON response (HTTP {response.status_code}).") from e
+        raise Proxy6APIError(f"Proxy6 invalid JSON response (HTTP {status}).") from e
 
     if not isinstance(payload, dict):
         raise Proxy6APIError("Proxy6 response format is invalid.")
@@ -803,8 +2120,8 @@ def _proxy6_call_sync(method, params=None):
             raise Proxy6APIError(f"{error_text} (error_id={error_id})", error_id=error_id)
         raise Proxy6APIError(error_text)
 
-    if response.status_code >= 400:
-        raise Proxy6APIError(f"Proxy6 HTTP error {response.status_code}.")
+    if status >= 400:
+        raise Proxy6APIError(f"Proxy6 HTTP error {status}.")
 
     return payload
 
@@ -883,7 +2200,7 @@ def _format_proxy6_error(err):
 
 
 async def get_proxy6_proxies(state="all"):
-    payload = await asyncio.to_thread(_proxy6_call_sync, "getproxy", {"state": state})
+    payload = await _proxy6_call("getproxy", {"state": state})
     items = _proxy6_extract_items(payload)
     try:
         return sorted(items, key=lambda x: int(x.get("id", 0)))
@@ -898,12 +2215,12 @@ def _find_proxy_by_id(items, proxy_id):
     return None
 
 
-def _check_proxy_sync(proxy):
+async def _check_proxy(proxy):
     cmd = [
         "curl", "-sS", "-m", str(PROXY_CHECK_TIMEOUT_SEC),
         "--proxy", proxy, "-o", "/dev/null", "-w", "%{http_code}", PROXY_CHECK_URL
     ]
-    proc = subprocess.run(cmd, capture_output=True, text=True)
+    proc = await run_process(cmd, timeout=PROXY_CHECK_TIMEOUT_SEC + 5, capture_stdout=True, label="curl proxy check")
     if proc.returncode != 0:
         return False, (proc.stderr or f"curl rc={proc.returncode}").strip()
     code = (proc.stdout or "").strip()
@@ -912,19 +2229,20 @@ def _check_proxy_sync(proxy):
     return False, f"http {code or '000'}"
 
 
-def _run_proxy_health_checks_sync():
+async def _run_proxy_health_checks():
     grouped = {}
     for source_name, proxy in _collect_proxy_sources():
         grouped.setdefault(proxy, []).append(source_name)
+    checks = await asyncio.gather(*(_check_proxy(proxy) for proxy in grouped), return_exceptions=True)
     results = []
-    for proxy, source_names in grouped.items():
-        ok, detail = _check_proxy_sync(proxy)
+    for (proxy, source_names), check in zip(grouped.items(), checks):
+        ok, detail = check if not isinstance(check, Exception) else (False, str(check))
         results.append({"proxy": proxy, "sources": source_names, "ok": ok, "detail": detail})
     return results
 
 
 async def run_proxy_health_check(app, reason):
-    results = await asyncio.to_thread(_run_proxy_health_checks_sync)
+    results = await _run_proxy_health_checks()
     if not results:
         logger.info("Proxy health check skipped: no proxies configured.")
         return
@@ -1159,7 +2477,7 @@ async def download_reddit_cli(url):
             target_url,
         )
         try:
-            proc = await asyncio.to_thread(subprocess.run, cmd, capture_output=True, text=True)
+            proc = await run_process(cmd, timeout=DOWNLOAD_PROCESS_TIMEOUT_SEC, capture_stdout=True, label="yt-dlp reddit")
             if proc.returncode == 0 and os.path.exists(fname):
                 return fname
             stderr = (proc.stderr or "").strip()
@@ -1196,6 +2514,290 @@ async def download_reddit_cli(url):
 
     return last_code
 
+def _ydl_info_cache_key(url, opts):
+    base = canonical_content_id(url) or normalize_link_for_cache(url) or url
+    return (base, opts.get('proxy') or "", opts.get('cookiefile') or "")
+
+
+def _extract_raw_info(ydl, url, cache_key):
+    with ydl_info_cache_lock:
+        cached = ydl_info_cache.get(cache_key)
+    if cached is not MediaCacheLRU.MISS:
+        return copy.deepcopy(cached)
+    info = ydl.extract_info(url, download=False, process=False)
+    # Only concrete videos are reusable; url/playlist results still resolve during processing.
+    if YTDLP_INFO_CACHE_TTL_SEC > 0 and info.get('_type', 'video') == 'video':
+        with ydl_info_cache_lock:
+            ydl_info_cache.put(cache_key, copy.deepcopy(info))
+    return info
+
+
+def _estimated_filesize(info):
+    parts = info.get('requested_formats') or [info]
+    return sum((_format_size(f, info.get('duration')) or 0) for f in parts)
+
+
+def _format_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    tbr = fmt.get('tbr') or ((fmt.get('vbr') or 0) + (fmt.get('abr') or 0))
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def _budget_format_spec(info, budget):
+    """
+    Format spec for the best format (or video+audio pair) at or below the selected height
+    whose estimated size fits budget; None when nothing known fits. H.264+AAC candidates
+    (deliverable without a re-encode) are tried first, and VP9/AV1 etc. only when none of
+    them fits; within each group height wins, then container preference, then size.
+    """
+    formats = info.get('formats') or []
+    duration = info.get('duration')
+    selected = info.get('requested_formats') or [info]
+    preferred_exts = {f.get('ext') for f in selected if f.get('ext')}
+
+    # A missing codec field means unknown, not absent; only an explicit 'none' rules a stream out.
+    def has_video(f):
+        return f.get('vcodec') != 'none'
+
+    def has_audio(f):
+        return f.get('acodec') != 'none'
+
+    def is_h264(f):
+        vcodec = str(f.get('vcodec') or '')
+        return vcodec.startswith(('avc1', 'h264')) or (not vcodec and f.get('ext') == 'mp4')
+
+    def is_aac(f):
+        acodec = str(f.get('acodec') or '')
+        return acodec.startswith('mp4a') or (not acodec and f.get('ext') in ('mp4', 'm4a'))
+
+    def compat(v, a):
+        return (
+            int(str(v.get('vcodec') or '').startswith(('avc1', 'h264')))
+            + int(str(a.get('acodec') or '').startswith('mp4a'))
+            + int(v.get('ext') in preferred_exts)
+            + int(a.get('ext') in preferred_exts)
+        )
+
+    def audio_rate(f):
+        return f.get('abr') or f.get('tbr') or 0
+
+    budget = budget * 0.97  # container/mux overhead
+    sized = [(f, _format_size(f, duration)) for f in formats if f.get('format_id')]
+    sized = [(f, size) for f, size in sized if size]
+    audios = sorted(
+        ((f, size) for f, size in sized if has_audio(f) and not has_video(f)),
+        key=lambda x: audio_rate(x[0]),
+        reverse=True,
+    )
+
+    if not any(has_video(f) for f in selected):
+        fitting = [(f, size) for f, size in audios if size <= budget]
+        return fitting[0][0]['format_id'] if fitting else None
+
+    max_height = max((f.get('height') or 0) for f in selected) or None
+    candidates = []
+    for f, size in sized:
+        if not has_video(f):
+            continue
+        height = f.get('height') or 0
+        if max_height and height > max_height:
+            continue
+        if has_audio(f):
+            if size <= budget:
+                candidates.append(((int(is_h264(f) and is_aac(f)), height, compat(f, f), 1, size), f['format_id']))
+            continue
+        for a, audio_size in audios:
+            if size + audio_size <= budget:
+                # Same-family pairs merge without re-encoding into mp4/webm.
+                same_family = (f.get('ext'), a.get('ext')) in {("mp4", "m4a"), ("webm", "webm")}
+                candidates.append((
+                    (int(is_h264(f) and is_aac(a)), height, compat(f, a), int(same_family), size + audio_size),
+                    f"{f['format_id']}+{a['format_id']}",
+                ))
+    return max(candidates)[1] if candidates else None
+
+
+def _select_within_budget(ydl, raw, url):
+    """Selects formats offline from raw info, stepping down in resolution to fit MAX_FILE_SIZE."""
+    info = ydl.process_ie_result(copy.deepcopy(raw), download=False)
+    if _estimated_filesize(info) <= MAX_FILE_SIZE:
+        return info
+    spec = _budget_format_spec(info, MAX_FILE_SIZE) if info.get('formats') else None
+    if not spec:
+        logger.warning(f"File too large (estimated): {url}")
+        return "TOO_LARGE"
+    logger.info(f"📉 {url}: selected format exceeds size budget, using {spec}")
+    ydl.format_selector = ydl.build_format_selector(spec)
+    info = ydl.process_ie_result(copy.deepcopy(raw), download=False)
+    if _estimated_filesize(info) > MAX_FILE_SIZE:
+        logger.warning(f"File too large (estimated after step-down): {url}")
+        return "TOO_LARGE"
+    return info
+
+
+def _resolve_media_streams(url, opts):
+    """
+    Blocking: extracts and selects formats without downloading.
+    Returns a list of {"url", "headers", "ext", "vcodec", "acodec"} (video part first) or an error code.
+    """
+    try:
+        with yt_dlp.YoutubeDL(dict(opts, quiet=True, skip_download=True)) as ydl:
+            raw = _extract_raw_info(ydl, url, _ydl_info_cache_key(url, opts))
+            if raw.get('_type') == 'playlist':
+                # Carousel posts: take the first video entry.
+                entries = [e for e in (raw.get('entries') or []) if e and e.get('formats')]
+                if not entries:
+                    return "ERR_UNSUPPORTED_LINK"
+                raw = entries[0]
+            info = _select_within_budget(ydl, raw, url)
+    except Exception as e:
+        logger.error(f"Stream resolve error: {e}")
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+    if info == "TOO_LARGE":
+        return "TOO_LARGE"
+    parts = info.get('requested_formats') or [info]
+    parts = sorted(parts, key=lambda p: (p.get('vcodec') or 'none') == 'none')
+    return [
+        {
+            "url": p.get('url'),
+            "headers": dict(p.get('http_headers') or info.get('http_headers') or {}),
+            "ext": p.get('ext') or 'mp4',
+            "vcodec": p.get('vcodec'),
+            "acodec": p.get('acodec'),
+        }
+        for p in parts if p.get('url')
+    ]
+
+
+def _run_ydl(url, opts, dl_id):
+    """
+    Blocking yt-dlp run; returns the final path or an error code ("TOO_LARGE", "ERR_*").
+    Arguments and result are plain picklable values so it can run in ydl_process_pool.
+    """
+    produced_files = []
+    def _hook(d):
+        fn = d.get("filename")
+        if d.get("status") == "finished" and fn:
+            produced_files.append(fn)
+
+    info_key = _ydl_info_cache_key(url, opts)
+
+    def _attempt(run_opts):
+        # One extraction: format selection and download both work from the same raw info dict.
+        run_opts = dict(run_opts)
+        run_opts['progress_hooks'] = [_hook]
+        with yt_dlp.YoutubeDL(run_opts) as ydl:
+            raw = _extract_raw_info(ydl, url, info_key)
+            info = _select_within_budget(ydl, raw, url)
+            if info == "TOO_LARGE":
+                return "TOO_LARGE"
+            try:
+                ydl.process_ie_result(info, download=True)
+            except Exception:
+                # Cached format URLs may have expired; the next request re-extracts.
+                with ydl_info_cache_lock:
+                    ydl_info_cache.invalidate(info_key)
+                raise
+        return "OK"
+
+    try:
+        result = _attempt(opts)
+    except Exception as e:
+        msg = str(e)
+        if "Requested format is not available" in msg and opts.get("format") != "best":
+            try:
+                fallback_opts = dict(opts)
+                fallback_opts["format"] = "best"
+                result = _attempt(fallback_opts)
+            except Exception as e2:
+                logger.error(f"YDL Error (fallback): {e2}")
+                return classify_downloader_error(str(e2), default_code="ERR_DOWNLOAD_FAILED")
+        else:
+            logger.error(f"YDL Error: {e}")
+            return classify_downloader_error(msg, default_code="ERR_DOWNLOAD_FAILED")
+
+    if result == "TOO_LARGE":
+        return "TOO_LARGE"
+
+    # Use actual output path reported by yt-dlp, then normalize to our random name.
+    candidates = [p for p in produced_files if os.path.exists(p)]
+    if not candidates:
+        prefix = f"{dl_id}."
+        for f in os.listdir(BASE_DIR):
+            if f.startswith(prefix) and not f.endswith((".part", ".ytdl", ".tmp")):
+                p = os.path.join(BASE_DIR, f)
+                if os.path.isfile(p):
+                    candidates.append(p)
+
+    if candidates:
+        produced = max(candidates, key=os.path.getsize)
+        ext = os.path.splitext(produced)[1] or ".mp4"
+        final_path = os.path.join(BASE_DIR, f"{dl_id}{ext}")
+        if os.path.abspath(produced) != os.path.abspath(final_path):
+            os.replace(produced, final_path)
+        if os.path.getsize(final_path) > MAX_FILE_SIZE:
+            logger.warning(f"File too large (actual): {final_path}")
+            os.remove(final_path)
+            return "TOO_LARGE"
+        return final_path
+    return "ERR_DOWNLOAD_FAILED"
+
+
+def _ydl_worker_init():
+    # Ctrl+C goes to the whole process group; let the bot process drive shutdown.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from yt_dlp.extractor import gen_extractor_classes
+    gen_extractor_classes()
+
+
+def _ydl_worker_ping():
+    return os.getpid()
+
+
+def start_ydl_process_pool():
+    """
+    Forks pre-warmed yt-dlp workers.
+    Called from main() before any thread or event loop exists, so fork is safe.
+    """
+    global ydl_process_pool
+    if not YTDLP_PROCESS_POOL_ENABLED or ydl_process_pool is not None:
+        return
+    try:
+        pool = ProcessPoolExecutor(
+            max_workers=YTDLP_PROCESS_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_ydl_worker_init,
+        )
+        pids = {f.result() for f in [pool.submit(_ydl_worker_ping) for _ in range(YTDLP_PROCESS_POOL_WORKERS)]}
+        ydl_process_pool = pool
+        logger.info(f"🧵 yt-dlp process pool ready ({YTDLP_PROCESS_POOL_WORKERS} workers, {len(pids)} warmed)")
+    except Exception as e:
+        logger.error(f"⚠️ yt-dlp process pool unavailable, using threads: {e}")
+
+
+async def run_in_ydl_executor(func, *args):
+    """Runs a picklable yt-dlp job in the process pool when enabled, else in a thread."""
+    global ydl_process_pool
+    pool = ydl_process_pool
+    if pool is not None:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except BrokenProcessPool as e:
+            logger.error(f"❌ yt-dlp process pool broken, falling back to threads: {e}")
+            if ydl_process_pool is pool:
+                ydl_process_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+    return await asyncio.to_thread(func, *args)
+
+
+async def run_ydl_job(url, opts, dl_id):
+    return await run_in_ydl_executor(_run_ydl, url, opts, dl_id)
+
+
 async def generic_download(url, opts_update=None):
     dl_id = f"dl_{uuid.uuid4().hex}"
     outtmpl = os.path.join(BASE_DIR, f"{dl_id}.%(ext)s")
@@ -1215,67 +2817,129 @@ async def generic_download(url, opts_update=None):
         opts['js_runtimes'] = YTDLP_JS_RUNTIMES
     if opts_update: opts.update(opts_update)
     
-    def _run_ydl():
-        produced_files = []
-        def _hook(d):
-            fn = d.get("filename")
-            if d.get("status") == "finished" and fn:
-                produced_files.append(fn)
-
-        def _attempt(run_opts):
-            run_opts = dict(run_opts)
-            run_opts['progress_hooks'] = [_hook]
-            with yt_dlp.YoutubeDL(run_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                if (info.get('filesize') or info.get('filesize_approx') or 0) > MAX_FILE_SIZE:
-                    logger.warning(f"File too large (estimated): {url}")
-                    return "TOO_LARGE"
-                ydl.download([url])
-            return "OK"
-
-        try:
-            result = _attempt(opts)
-        except Exception as e:
-            msg = str(e)
-            if "Requested format is not available" in msg and opts.get("format") != "best":
-                try:
-                    fallback_opts = dict(opts)
-                    fallback_opts["format"] = "best"
-                    result = _attempt(fallback_opts)
-                except Exception as e2:
-                    logger.error(f"YDL Error (fallback): {e2}")
-                    return classify_downloader_error(str(e2), default_code="ERR_DOWNLOAD_FAILED")
-            else:
-                logger.error(f"YDL Error: {e}")
-                return classify_downloader_error(msg, default_code="ERR_DOWNLOAD_FAILED")
-
-        if result == "TOO_LARGE":
-            return "TOO_LARGE"
-
-        # Use actual output path reported by yt-dlp, then normalize to our random name.
-        candidates = [p for p in produced_files if os.path.exists(p)]
-        if not candidates:
-            prefix = f"{dl_id}."
-            for f in os.listdir(BASE_DIR):
-                if f.startswith(prefix) and not f.endswith((".part", ".ytdl", ".tmp")):
-                    p = os.path.join(BASE_DIR, f)
-                    if os.path.isfile(p):
-                        candidates.append(p)
-
-        if candidates:
-            produced = max(candidates, key=os.path.getsize)
-            ext = os.path.splitext(produced)[1] or ".mp4"
-            final_path = os.path.join(BASE_DIR, f"{dl_id}{ext}")
-            if os.path.abspath(produced) != os.path.abspath(final_path):
-                os.replace(produced, final_path)
-            if os.path.getsize(final_path) > MAX_FILE_SIZE:
-                logger.warning(f"File too large (actual): {final_path}")
-                os.remove(final_path)
-                return "TOO_LARGE"
-            return final_path
-        return "ERR_DOWNLOAD_FAILED"
-
-    return await asyncio.to_thread(_run_ydl)
+    return await run_ydl_job(url, opts, dl_id)
+
+async def stream_to_file(url, path, max_bytes=MAX_FILE_SIZE, headers=None, proxy=None):
+    """
+    Streams url into path via a .part scratch file, aborting once max_bytes is exceeded.
+    Returns path, "TOO_LARGE" or an ERR_* code.
+    """
+    tmp_path = f"{path}.part"
+    try:
+        timeout = aiohttp.ClientTimeout(total=DIRECT_DOWNLOAD_TIMEOUT_SEC, sock_connect=HTTP_CONNECT_TIMEOUT_SEC)
+        async with http_clients.session(proxy).get(url, headers=headers, timeout=timeout) as resp:
+            if resp.status != 200:
+                return classify_downloader_error(f"http error {resp.status}", default_code="ERR_SOURCE_UNREACHABLE")
+            if resp.content_length and resp.content_length > max_bytes:
+                logger.warning(f"Direct download too large (Content-Length {resp.content_length}): {url}")
+                return "TOO_LARGE"
+            written = 0
+            with open(tmp_path, 'wb') as f:
+                async for chunk in resp.content.iter_chunked(DIRECT_DOWNLOAD_CHUNK_BYTES):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        logger.warning(f"Direct download exceeded {max_bytes} bytes, aborting: {url}")
+                        return "TOO_LARGE"
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+        return path
+    except asyncio.TimeoutError:
+        return "ERR_TIMEOUT"
+    except Exception as e:
+        logger.error(f"Direct download error: {e}")
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+    finally:
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except: pass
+
+
+def _parse_content_range_total(value):
+    # "bytes 0-0/12345" -> 12345; "*" or malformed -> None
+    match = re.match(r"bytes\s+\d+-\d+/(\d+)", value or "")
+    return int(match.group(1)) if match else None
+
+
+async def _fetch_range(session, url, fd, start, end, headers, proxy, timeout):
+    range_headers = dict(headers or {})
+    range_headers["Range"] = f"bytes={start}-{end}"
+    offset = start
+    async with session.get(url, headers=range_headers, proxy=proxy, timeout=timeout) as resp:
+        if resp.status != 206:
+            raise RuntimeError(f"range {start}-{end}: http {resp.status}")
+        async for chunk in resp.content.iter_chunked(DIRECT_DOWNLOAD_CHUNK_BYTES):
+            if offset + len(chunk) > end + 1:
+                raise RuntimeError(f"range {start}-{end}: server sent extra bytes")
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    if offset != end + 1:
+        raise RuntimeError(f"range {start}-{end}: short read ({offset - start} bytes)")
+    return offset - start
+
+
+async def download_direct(url, path, max_bytes=MAX_FILE_SIZE, headers=None, proxy=None):
+    """
+    Downloads a direct media URL, splitting large files into parallel byte ranges written with pwrite
+    into a preallocated scratch file. Falls back to a single stream when ranges are unsupported or the
+    file is small. Returns path, "TOO_LARGE" or an ERR_* code.
+    """
+    if RANGED_DOWNLOAD_CONNECTIONS < 2:
+        return await stream_to_file(url, path, max_bytes, headers, proxy)
+    session = http_clients.session(proxy)
+    timeout = aiohttp.ClientTimeout(total=DIRECT_DOWNLOAD_TIMEOUT_SEC, sock_connect=HTTP_CONNECT_TIMEOUT_SEC)
+    try:
+        probe_headers = dict(headers or {})
+        probe_headers["Range"] = "bytes=0-0"
+        async with session.get(url, headers=probe_headers, timeout=timeout) as resp:
+            total = _parse_content_range_total(resp.headers.get("Content-Range")) if resp.status == 206 else None
+    except Exception as e:
+        logger.info(f"Range probe failed, using single stream: {e}")
+        total = None
+    if total is not None and total > max_bytes:
+        logger.warning(f"Direct download too large ({total} bytes): {url}")
+        return "TOO_LARGE"
+    if not total or total < RANGED_DOWNLOAD_MIN_BYTES:
+        return await stream_to_file(url, path, max_bytes, headers, proxy)
+
+    tmp_path = f"{path}.part"
+    part = -(-total // RANGED_DOWNLOAD_CONNECTIONS)
+    ranges = [(start, min(start + part, total) - 1) for start in range(0, total, part)]
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, total)
+        tasks = [
+            asyncio.create_task(_fetch_range(session, url, fd, start, end, headers, proxy, timeout))
+            for start, end in ranges
+        ]
+        try:
+            received = sum(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # The file was preallocated, so only the per-range byte counts prove every range landed.
+        if received != total:
+            raise RuntimeError(f"size mismatch: {received} != {total}")
+        os.close(fd)
+        fd = None
+        os.replace(tmp_path, path)
+        logger.info(f"⚡ Ranged download: {total} bytes over {len(ranges)} connections")
+        return path
+    except asyncio.CancelledError:
+        raise
+    except asyncio.TimeoutError:
+        return "ERR_TIMEOUT"
+    except Exception as e:
+        logger.error(f"Ranged download error: {e}")
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except: pass
+
 
 async def download_pinterest(url):
     try:
@@ -1283,11 +2947,12 @@ async def download_pinterest(url):
             'x-rapidapi-key': RAPID_API_KEY,
             'x-rapidapi-host': "pinterest-video-and-image-downloader.p.rapidapi.com"
         }
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get("https://pinterest-video-and-image-downloader.p.rapidapi.com/pinterest", params={"url": url}, headers=headers) as resp:
-                if resp.status != 200:
-                    return classify_downloader_error(f"http error {resp.status}", default_code="ERR_SOURCE_UNREACHABLE")
-                data = await resp.json()
+        async with http_clients.session().get(
+            "https://pinterest-video-and-image-downloader.p.rapidapi.com/pinterest", params={"url": url}, headers=headers
+        ) as resp:
+            if resp.status != 200:
+                return classify_downloader_error(f"http error {resp.status}", default_code="ERR_SOURCE_UNREACHABLE")
+            data = await resp.json()
         
         if not data.get('success'):
             return "ERR_UNAVAILABLE"
@@ -1298,43 +2963,105 @@ async def download_pinterest(url):
             return "ERR_UNSUPPORTED_LINK"
         
         ext = 'jpg' if data.get('type') == 'image' else 'mp4'
-        fname = f"pin_{uuid.uuid4().hex}.{ext}"
-        
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(target_url) as resp:
-                if resp.status == 200:
-                    content = await resp.read()
-                    if len(content) > MAX_FILE_SIZE:
-                        logger.warning(f"Pinterest file too large: {len(content)}")
-                        return "TOO_LARGE"
-                    with open(fname, 'wb') as f: f.write(content)
-                    return fname
-                return classify_downloader_error(f"http error {resp.status}", default_code="ERR_SOURCE_UNREACHABLE")
+        fname = os.path.join(BASE_DIR, f"pin_{uuid.uuid4().hex}.{ext}")
+        return await download_direct(target_url, fname)
     except Exception as e:
         logger.error(f"Pinterest error: {e}")
-    return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+
+async def download_instagram_helper(url):
+    fname = f"inst_{uuid.uuid4().hex}.mp4"
+    try:
+        # Use nice/ionice for the shell script too
+        proc = await run_process(
+            ["nice", "-n", "19", INSTAGRAM_HELPER, url, fname],
+            timeout=DOWNLOAD_PROCESS_TIMEOUT_SEC,
+            label="instagram helper",
+        )
+        if proc.returncode == 0 and os.path.exists(fname):
+            if os.path.getsize(fname) > MAX_FILE_SIZE:
+                os.remove(fname)
+                return "TOO_LARGE"
+            return fname
+        if proc.returncode != 0:
+            logger.error("Instagram helper failed. RC: %s STDERR: %s", proc.returncode, proc.stderr)
+            return classify_downloader_error(proc.stderr, default_code="ERR_DOWNLOAD_FAILED")
+        return "ERR_DOWNLOAD_FAILED"
+    except Exception as e:
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+
+
+def _instagram_proxy():
+    return INSTAGRAM_CONFIG.get("proxy") or PROXIES.get("instagram") or _extract_instagram_helper_proxy()
+
+
+async def download_instagram(url):
+    """
+    Resolves stream URLs via the proxy, fetches video/audio parts in parallel
+    and stream-copies them into one mp4 (no re-encode here).
+    """
+    cookie_file = COOKIES.get("instagram") or INSTAGRAM_DEFAULT_COOKIES
+    opts = {
+        'proxy': _instagram_proxy(),
+        'format': YTDLP_INSTAGRAM_FORMAT,
+        'socket_timeout': YTDLP_SOCKET_TIMEOUT,
+        'nocheckcertificate': True,
+    }
+    if cookie_file and os.path.exists(cookie_file):
+        opts['cookiefile'] = cookie_file
+    parts = await run_in_ydl_executor(_resolve_media_streams, url, opts)
+    if isinstance(parts, str):
+        return parts
+    if not parts:
+        return "ERR_DOWNLOAD_FAILED"
+
+    dl_id = f"inst_{uuid.uuid4().hex}"
+    final_path = os.path.join(BASE_DIR, f"{dl_id}.mp4")
+    part_paths = [os.path.join(BASE_DIR, f"{dl_id}_{i}.{p['ext']}") for i, p in enumerate(parts)]
+    try:
+        results = await asyncio.gather(*(
+            download_direct(p["url"], path, headers=p["headers"], proxy=None if INSTAGRAM_DIRECT_PARTS else opts['proxy'])
+            for p, path in zip(parts, part_paths)
+        ))
+        for result in results:
+            if result == "TOO_LARGE" or (isinstance(result, str) and result.startswith("ERR_")):
+                return result
+        if sum(os.path.getsize(p) for p in part_paths) > MAX_FILE_SIZE:
+            return "TOO_LARGE"
+
+        cmd = ["nice", "-n", "19", "ffmpeg", "-y", "-loglevel", "error"]
+        for path in part_paths:
+            cmd.extend(["-i", path])
+        if len(part_paths) > 1:
+            cmd.extend(["-map", "0:v:0", "-map", "1:a:0"])
+        cmd.extend(["-c", "copy", "-movflags", "+faststart", final_path])
+        proc = await run_process(cmd, timeout=FFMPEG_TIMEOUT_SEC, label="ffmpeg instagram merge")
+        if proc.returncode != 0 or not os.path.exists(final_path):
+            logger.error(f"❌ Instagram merge failed (rc={proc.returncode}): {proc.stderr[-500:]}")
+            if os.path.exists(final_path): os.remove(final_path)
+            return "ERR_DOWNLOAD_FAILED"
+        if os.path.getsize(final_path) > MAX_FILE_SIZE:
+            os.remove(final_path)
+            return "TOO_LARGE"
+        return final_path
+    except Exception as e:
+        logger.error(f"Instagram pipeline error: {e}")
+        return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+    finally:
+        for path in part_paths:
+            if os.path.exists(path):
+                try: os.remove(path)
+                except: pass
+
 
 async def download_router(url):
     low_url = (url or "").lower()
     if "pinterest" in low_url or "pin.it" in low_url:
         return await download_pinterest(url)
     elif "instagram.com" in low_url:
-        fname = f"inst_{uuid.uuid4().hex}.mp4"
-        try:
-            # Use nice/ionice for the shell script too
-            proc = await asyncio.to_thread(subprocess.run, ["nice", "-n", "19", INSTAGRAM_HELPER, url, fname], capture_output=True)
-            if proc.returncode == 0 and os.path.exists(fname):
-                if os.path.getsize(fname) > MAX_FILE_SIZE:
-                    os.remove(fname)
-                    return "TOO_LARGE"
-                return fname
-            if proc.returncode != 0:
-                stderr = (proc.stderr or b"").decode(errors="ignore")
-                logger.error("Instagram helper failed. RC: %s STDERR: %s", proc.returncode, stderr)
-                return classify_downloader_error(stderr, default_code="ERR_DOWNLOAD_FAILED")
-            return "ERR_DOWNLOAD_FAILED"
-        except Exception as e:
-            return classify_downloader_error(str(e), default_code="ERR_DOWNLOAD_FAILED")
+        if INSTAGRAM_USE_HELPER_SCRIPT:
+            return await download_instagram_helper(url)
+        return await download_instagram(url)
     elif "reddit" in low_url or "redd.it" in low_url:
         res = await download_reddit_cli(url)
         if res and os.path.exists(res) and os.path.getsize(res) > MAX_FILE_SIZE:
@@ -1373,7 +3100,49 @@ async def download_router(url):
     
     return await generic_download(url, opts)
 
-async def convert_media(path, to_audio=False):
+def _audio_convert_cmds(path, codec, title=None, artist=None):
+    """ffmpeg (out, cmd) attempts for audio: stream copy when the codec already plays in Telegram, then MP3."""
+    base = os.path.splitext(path)[0]
+    tags = []
+    if title: tags += ["-metadata", f"title={title}"]
+    if artist: tags += ["-metadata", f"artist={artist}"]
+    attempts = []
+    if codec in AUDIO_COPY_CODECS:
+        ext = AUDIO_COPY_CONTAINERS[codec]
+        out = f"{base}_c.{ext}"
+        faststart = ["-movflags", "+faststart"] if ext == "m4a" else []
+        attempts.append((out, ["nice", "-n", "19", "ffmpeg", "-i", path, "-vn", "-c:a", "copy", *faststart, *tags, out, "-y", "-loglevel", "error"]))
+    out = f"{base}_c.mp3"
+    attempts.append((out, ["nice", "-n", "19", "ffmpeg", "-i", path, "-vn", "-b:a", AUDIO_TRANSCODE_BITRATE, *tags, out, "-y", "-loglevel", "error"]))
+    return attempts
+
+
+def _video_copy_ok(probe):
+    """H.264, 8-bit 4:2:0, in a profile every Telegram client decodes."""
+    return bool(
+        probe
+        and probe["video"] == "h264"
+        and probe.get("pix_fmt") in TELEGRAM_PIX_FMTS
+        and (probe.get("video_profile") or "High") in TELEGRAM_H264_PROFILES
+    )
+
+
+def _video_convert_cmds(path, probe):
+    """ffmpeg (out, cmd) attempts for video: remux or copy-video when the streams allow it, then full transcode."""
+    out = f"{os.path.splitext(path)[0]}_c.mp4"
+    ffmpeg = ["nice", "-n", "19", "ffmpeg", "-i", path]
+    tail = ["-movflags", "+faststart", out, "-y", "-loglevel", "error"]
+    attempts = []
+    if _video_copy_ok(probe):
+        if probe["audio"] in (None, "aac", "mp3"):
+            attempts.append((out, ffmpeg + ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"] + tail))
+        else:
+            attempts.append((out, ffmpeg + ["-map", "0:v:0", "-map", "0:a:0?", "-c:v", "copy", "-c:a", "aac", "-b:a", "128k"] + tail))
+    attempts.append((out, ffmpeg + ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "128k"] + tail))
+    return attempts
+
+
+async def convert_media(path, to_audio=False, title=None, artist=None):
     if not path or not os.path.exists(path): return None
     if path == "TOO_LARGE": return "TOO_LARGE"
     
@@ -1381,12 +3150,24 @@ async def convert_media(path, to_audio=False):
         logger.warning(f"File too large for conversion: {path}")
         return "TOO_LARGE"
 
-    out = f"{os.path.splitext(path)[0]}_c.{'mp3' if to_audio else 'mp4'}"
     # Add nice -n 19 to ffmpeg calls
-    cmd = ["nice", "-n", "19", "ffmpeg", "-i", path, "-vn", "-b:a", "192k", out, "-y", "-loglevel", "error"] if to_audio else \
-          ["nice", "-n", "19", "ffmpeg", "-i", path, "-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", "-b:a", "128k", out, "-y", "-loglevel", "error"]
+    if to_audio:
+        probe = await probe_media(path)
+        attempts = _audio_convert_cmds(path, probe["audio"] if probe else None, title, artist)
+    else:
+        probe = await probe_media(path)
+        attempts = _video_convert_cmds(path, probe)
+        if len(attempts) > 1:
+            logger.info(f"⚡ Remuxing {os.path.basename(path)} without re-encoding video ({probe['video']}/{probe['audio']})")
     try:
-        await asyncio.to_thread(subprocess.run, cmd, check=True)
+        for attempt, (out, cmd) in enumerate(attempts, 1):
+            proc = await run_process(cmd, timeout=FFMPEG_TIMEOUT_SEC, label="ffmpeg convert")
+            if proc.returncode == 0:
+                break
+            logger.error(f"❌ ffmpeg convert failed (rc={proc.returncode}): {proc.stderr[-500:]}")
+            if os.path.exists(out): os.remove(out)
+            if attempt == len(attempts):
+                return None
         os.remove(path)
         if os.path.exists(out) and os.path.getsize(out) > MAX_FILE_SIZE:
             os.remove(out)
@@ -1395,6 +3176,49 @@ async def convert_media(path, to_audio=False):
     except: return None
 
 
+async def probe_media(path):
+    """
+    ffprobe summary: {"format": names, "video": codec, "audio": codec, "video_profile", "pix_fmt"};
+    None if probing fails.
+    """
+    cmd = [
+        "ffprobe", "-v", "error", "-show_entries", "format=format_name:stream=codec_type,codec_name,profile,pix_fmt",
+        "-of", "json", path,
+    ]
+    try:
+        proc = await run_process(cmd, timeout=30, capture_stdout=True, label="ffprobe")
+        if proc.returncode != 0:
+            return None
+        data = json.loads(proc.stdout or "{}")
+    except Exception as e:
+        logger.warning(f"ffprobe failed for {path}: {e}")
+        return None
+    result = {
+        "format": (data.get("format") or {}).get("format_name", ""),
+        "video": None, "audio": None, "video_profile": None, "pix_fmt": None,
+    }
+    for stream in data.get("streams") or []:
+        kind = stream.get("codec_type")
+        if kind in ("video", "audio") and result[kind] is None:
+            result[kind] = stream.get("codec_name")
+            if kind == "video":
+                result["video_profile"] = stream.get("profile")
+                result["pix_fmt"] = stream.get("pix_fmt")
+    return result
+
+
+async def is_telegram_ready_video(path):
+    """mp4 with H.264 video and AAC/MP3 (or no) audio plays inline in Telegram without re-encoding."""
+    if not is_mp4_container(path):
+        return False
+    probe = await probe_media(path)
+    return bool(
+        _video_copy_ok(probe)
+        and "mp4" in probe["format"]
+        and probe["audio"] in (None, "aac", "mp3")
+    )
+
+
 def is_mp4_container(path):
     try:
         return os.path.splitext(path or "")[1].lower() == ".mp4"
@@ -1405,48 +3229,373 @@ async def extract_opus(video_path):
     out = f"{video_path}_speech.ogg"
     cmd = ["nice", "-n", "19", "ffmpeg", "-i", video_path, "-vn", "-c:a", "libopus", "-b:a", "64k", "-ar", "48000", out, "-y", "-loglevel", "error"]
     try:
-        await asyncio.to_thread(subprocess.run, cmd, check=True)
+        proc = await run_process(cmd, timeout=FFMPEG_TIMEOUT_SEC, label="ffmpeg opus")
+        if proc.returncode != 0:
+            logger.error(f"❌ ffmpeg opus extract failed (rc={proc.returncode}): {proc.stderr[-500:]}")
+            if os.path.exists(out): os.remove(out)
+            return None
         return out
     except: return None
 
-def get_proxies(): return {"http": PROXIES["yandex"], "https": PROXIES["yandex"]} if PROXIES.get("yandex") else None
-def get_ym_track_info(url):
-    try:
-        resp = requests.get(f"https://api.music.yandex.net/tracks/{url.split('/')[-1].split('?')[0]}", headers={"Authorization": HEADERS.get("yandex_auth")}, proxies=get_proxies(), timeout=15)
-        t = resp.json()['result'][0]
-        return t['title'], ', '.join([a['name'] for a in t['artists']])
-    except: return None, None
-def get_spotify_info(url):
+async def cached_music_metadata(content_id, loader):
+    """
+    Track metadata by content ID: LRU, then music_metadata, then loader().
+    Empty results are only cached briefly in memory.
+    """
+    if not content_id:
+        return await loader()
+    cached = music_metadata_lru.get(content_id)
+    if cached is not MediaCacheLRU.MISS:
+        return cached
+    if db_pool:
+        try:
+            async with db_pool.acquire() as conn:
+                payload = await conn.fetchval(
+                    "SELECT payload FROM music_metadata WHERE content_id = $1 AND expires_at > CURRENT_TIMESTAMP",
+                    content_id,
+                )
+            if payload:
+                value = json.loads(payload)
+                music_metadata_lru.put(content_id, value)
+                return value
+        except Exception as e:
+            logger.warning(f"Music metadata cache read failed: {e}")
+    value = await loader()
+    music_metadata_lru.put(content_id, value or None)
+    if value and db_pool:
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO music_metadata (content_id, payload, expires_at)
+                    VALUES ($1, $2, CURRENT_TIMESTAMP + make_interval(secs => $3))
+                    ON CONFLICT (content_id)
+                    DO UPDATE SET payload = EXCLUDED.payload, expires_at = EXCLUDED.expires_at
+                    """,
+                    content_id, json.dumps(value, ensure_ascii=False), float(MUSIC_METADATA_TTL_SEC),
+                )
+        except Exception as e:
+            logger.warning(f"Music metadata cache write failed: {e}")
+    return value
+
+
+def music_track_key(title, artist):
+    """Normalized "track:artist|title" cache key shared by every service and album that yields the same track."""
+    def _norm(value):
+        value = unicodedata.normalize("NFKC", value or "").casefold()
+        return " ".join(re.sub(r"[^\w]+", " ", value).split())
+
+    title, artist = _norm(title), _norm(artist)
+    return f"track:{artist}|{title}" if title and artist else None
+
+
+def _search_youtube_video_id(query):
     try:
-        resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
-        title = re.search(r'<meta property="og:title" content="(.*?)"', resp.text).group(1)
-        artist = re.search(r'<meta property="og:description" content="(.*?)"', resp.text).group(1).split('·')[0].strip()
-        return title, artist
-    except: return None, None
-def get_ym_album_info(url):
+        opts = {'quiet': True, 'extract_flat': 'in_playlist', 'socket_timeout': YTDLP_SOCKET_TIMEOUT}
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            result = ydl.extract_info(f"ytsearch1:{query}", download=False)
+        entries = [e for e in (result.get('entries') or []) if e and e.get('id')]
+        return entries[0]['id'] if entries else None
+    except Exception as e:
+        logger.warning(f"YouTube search failed for {query!r}: {e}")
+        return None
+
+
+async def resolve_track_download_url(title, artist):
+    """YouTube watch URL for a track (search result cached in music_metadata), or a ytsearch1: query."""
+    query = f"{title} {artist}"
+    track_key = music_track_key(title, artist)
+    if not track_key:
+        return f"ytsearch1:{query}"
+    video_id = await cached_music_metadata(
+        f"ytsearch:{track_key}", lambda: run_in_ydl_executor(_search_youtube_video_id, query)
+    )
+    return f"https://www.youtube.com/watch?v={video_id}" if video_id else f"ytsearch1:{query}"
+
+
+async def download_track_audio(dl_url, title=None, artist=None):
+    """Downloads one track as Telegram-playable audio; returns the path, "TOO_LARGE" or an ERR_* code."""
+    raw = await generic_download(dl_url, {'noplaylist': True, 'format': YTDLP_MUSIC_FORMAT})
+    if not raw: return "ERR_DOWNLOAD_FAILED"
+    if raw == "TOO_LARGE" or raw.startswith("ERR_"): return raw
+    f_path = await convert_media(raw, to_audio=True, title=title, artist=artist)
+    if os.path.exists(raw) and f_path != raw:
+        try: os.remove(raw)
+        except: pass
+    if not f_path: return "ERR_CONVERSION"
+    return f_path
+
+
+class AlbumTrack:
+    __slots__ = ("index", "title", "artist", "key", "file_id", "dl_url", "raw", "path", "error")
+
+    def __init__(self, index, title, artist):
+        self.index, self.title, self.artist = index, title, artist
+        self.key = self.file_id = self.dl_url = self.raw = self.path = self.error = None
+
+
+async def deliver_album(context, chat_id, owner, tracks, service, progress=None):
+    """
+    Staged album delivery: resolve -> download -> transcode, joined by bounded queues,
+    each stage with its own workers. Finished tracks are uploaded in track order as
+    sendMediaGroup albums of up to MEDIA_GROUP_MAX. Returns (sent, failed).
+    """
+    items = [AlbumTrack(i, title, artist) for i, (title, artist) in enumerate(tracks)]
+    ready = {}
+    ready_event = asyncio.Event()
+    counts = {"sent": 0, "failed": 0}
+
+    def _finish(item):
+        if item.error:
+            logger.warning(f"Album track skipped ({item.artist} - {item.title}): {item.error}")
+            counts["failed"] += 1
+        ready[item.index] = item
+        ready_event.set()
+
+    async def _resolve(item):
+        item.key = music_track_key(item.title, item.artist)
+        cached = await check_db_cache(item.key, "audio") if item.key else None
+        if cached:
+            item.file_id = cached["file_id"]
+            return False
+        item.dl_url = await resolve_track_download_url(item.title, item.artist)
+        return True
+
+    async def _download(item):
+        async with download_scheduler.slot("Music", owner, JobScheduler.PRIORITY_ALBUM):
+            raw = await generic_download(item.dl_url, {'noplaylist': True, 'format': YTDLP_MUSIC_FORMAT})
+        if not raw or raw == "TOO_LARGE" or raw.startswith("ERR_"):
+            item.error = raw or "ERR_DOWNLOAD_FAILED"
+            return False
+        item.raw = raw
+        return True
+
+    async def _transcode(item):
+        async with ALBUM_TRANSCODE_SEMAPHORE:
+            path = await convert_media(item.raw, to_audio=True, title=item.title, artist=item.artist)
+        if not path or path == "TOO_LARGE" or not os.path.exists(path):
+            item.error = path or "ERR_CONVERSION"
+        else:
+            item.path = path
+        return False
+
+    async def _stage(inbox, outbox, workers, downstream_workers, handler):
+        async def _worker():
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    return
+                try:
+                    forward = await handler(item)
+                except Exception as e:
+                    item.error, forward = str(e) or type(e).__name__, False
+                if forward:
+                    await outbox.put(item)
+                else:
+                    _finish(item)
+
+        await asyncio.gather(*(_worker() for _ in range(workers)))
+        for _ in range(downstream_workers):
+            await outbox.put(None)
+
+    async def _send_one(item):
+        try:
+            async with SEND_SEMAPHORE:
+                if item.file_id:
+                    return await context.bot.send_audio(chat_id, item.file_id)
+                with open(item.path, 'rb') as f:
+                    return await context.bot.send_audio(chat_id, f, title=item.title, performer=item.artist)
+        except Exception as e:
+            logger.warning(f"Album track send failed ({item.artist} - {item.title}): {e}")
+            if item.file_id and isinstance(e, BadRequest):
+                return await _refetch(item)
+            return None
+
+    async def _refetch(item):
+        """Stale cached file_id: drop it and run the track through resolve -> download -> transcode again."""
+        await delete_media_cache(item.key, "audio")
+        item.file_id = None
+        try:
+            item.dl_url = await resolve_track_download_url(item.title, item.artist)
+            if await _download(item):
+                await _transcode(item)
+        except Exception as e:
+            item.error = str(e) or type(e).__name__
+        if item.error or not item.path:
+            logger.warning(f"Album track re-download failed ({item.artist} - {item.title}): {item.error}")
+            return None
+        return await _send_one(item)
+
+    async def _send_batch(batch):
+        if len(batch) == 1:
+            sent = [await _send_one(batch[0])]
+        else:
+            files = []
+            try:
+                media = []
+                for item in batch:
+                    source = item.file_id
+                    if not source:
+                        source = open(item.path, 'rb')
+                        files.append(source)
+                    media.append(InputMediaAudio(source, title=item.title, performer=item.artist))
+                async with SEND_SEMAPHORE:
+                    sent = list(await context.bot.send_media_group(chat_id, media))
+            except BadRequest as e:
+                # One stale file_id fails the whole group; fall back to per-track sends.
+                logger.warning(f"Album media group rejected, sending tracks one by one: {e}")
+                sent = [await _send_one(item) for item in batch]
+            except Exception as e:
+                # Timeouts/network errors: Telegram may already have delivered the group, so never resend.
+                logger.warning(f"Album media group send failed or timed out ({len(batch)} tracks not confirmed): {e}")
+                sent = [None] * len(batch)
+            finally:
+                for f in files:
+                    f.close()
+
+        for item, message in zip(batch, sent):
+            audio = getattr(message, "audio", None)
+            if not audio:
+                counts["failed"] += 1
+                continue
+            counts["sent"] += 1
+            if item.key and not item.file_id:
+                await upsert_media_cache(item.key, "audio", audio.file_id, "audio", service, file_size=audio.file_size)
+
+    async def _deliver():
+        cursor, waiting_since = 0, None
+        while cursor < len(items):
+            batch, end = [], cursor
+            while end < len(items) and end in ready and len(batch) < MEDIA_GROUP_MAX:
+                if not ready[end].error:
+                    batch.append(ready[end])
+                end += 1
+            if not batch:
+                # Only failed tracks so far: step past them.
+                cursor, waiting_since = end, None
+                if end < len(items) and end not in ready:
+                    ready_event.clear()
+                    await ready_event.wait()
+                continue
+            if len(batch) < MEDIA_GROUP_MAX and end < len(items):
+                # A slow next track must not hold back the tracks already finished behind it.
+                waiting_since = waiting_since or time.monotonic()
+                remaining = ALBUM_BATCH_FLUSH_SEC - (time.monotonic() - waiting_since)
+                if remaining > 0:
+                    ready_event.clear()
+                    try:
+                        await asyncio.wait_for(ready_event.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            waiting_since = None
+            if batch:
+                await _send_batch(batch)
+                if progress:
+                    await progress(end, len(items))
+            cursor = end
+
+    resolve_q = asyncio.Queue()
+    download_q = asyncio.Queue(ALBUM_QUEUE_SIZE)
+    transcode_q = asyncio.Queue(ALBUM_QUEUE_SIZE)
+    resolve_workers = max(1, ALBUM_RESOLVE_CONCURRENCY)
+    download_workers = max(1, ALBUM_TRACK_CONCURRENCY)
+    transcode_workers = max(1, ALBUM_TRANSCODE_CONCURRENCY)
+    for item in items:
+        resolve_q.put_nowait(item)
+    for _ in range(resolve_workers):
+        resolve_q.put_nowait(None)
+
+    stages = [
+        asyncio.create_task(_stage(resolve_q, download_q, resolve_workers, download_workers, _resolve)),
+        asyncio.create_task(_stage(download_q, transcode_q, download_workers, transcode_workers, _download)),
+        asyncio.create_task(_stage(transcode_q, None, transcode_workers, 0, _transcode)),
+    ]
     try:
-        match = re.search(r'/album/(\d+)', url)
-        if not match: return []
-        resp = requests.get(f"https://api.music.yandex.net/albums/{match.group(1)}/with-tracks", headers={"Authorization": HEADERS.get("yandex_auth")}, proxies=get_proxies(), timeout=15)
-        tracks = []
-        for volume in resp.json()['result'].get('volumes', []):
-            for t in volume: tracks.append((t['title'], ', '.join([a['name'] for a in t['artists']])))
-        return tracks
-    except: return []
+        await _deliver()
+        await asyncio.gather(*stages)
+    finally:
+        for task in stages:
+            task.cancel()
+        for item in items:
+            for p in (item.raw, item.path):
+                if p and os.path.exists(p):
+                    try: os.remove(p)
+                    except: pass
+    return counts["sent"], counts["failed"]
+
+
+async def _ym_api_get(path):
+    async with http_clients.session(PROXIES.get("yandex")).get(
+        f"https://api.music.yandex.net/{path}",
+        headers={"Authorization": HEADERS.get("yandex_auth")},
+        timeout=aiohttp.ClientTimeout(total=15),
+    ) as resp:
+        return await resp.json(content_type=None)
+async def get_ym_track_info(url):
+    content_id = canonical_content_id(url)
+    track_id = content_id.rsplit(":", 1)[-1] if content_id and content_id.startswith("ym:track:") else url.split('/')[-1].split('?')[0]
+
+    async def _load():
+        try:
+            t = (await _ym_api_get(f"tracks/{track_id}"))['result'][0]
+            return [t['title'], ', '.join([a['name'] for a in t['artists']])]
+        except Exception as e:
+            logger.warning(f"Yandex Music track lookup failed for {track_id}: {e}")
+            return None
+
+    info = await cached_music_metadata(content_id, _load)
+    return tuple(info) if info else (None, None)
+async def _read_html_head(resp, limit=512 * 1024):
+    # og: tags live in <head>; stop reading there instead of pulling the whole page.
+    buf = b""
+    async for chunk in resp.content.iter_chunked(16384):
+        buf += chunk
+        if b"</head>" in buf or len(buf) >= limit:
+            break
+    return buf.split(b"</head>", 1)[0].decode(resp.charset or "utf-8", errors="ignore")
+async def get_spotify_info(url):
+    async def _load():
+        try:
+            async with http_clients.session().get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                text = await _read_html_head(resp)
+            title = html.unescape(re.search(r'<meta property="og:title" content="(.*?)"', text).group(1))
+            artist = html.unescape(re.search(r'<meta property="og:description" content="(.*?)"', text).group(1)).split('·')[0].strip()
+            return [title, artist]
+        except: return None
+
+    info = await cached_music_metadata(canonical_content_id(url), _load)
+    return tuple(info) if info else (None, None)
+async def get_ym_album_info(url):
+    match = re.search(r'/album/(\d+)', url)
+    if not match: return []
+
+    async def _load():
+        try:
+            data = await _ym_api_get(f"albums/{match.group(1)}/with-tracks")
+            tracks = []
+            for volume in data['result'].get('volumes', []):
+                for t in volume: tracks.append([t['title'], ', '.join([a['name'] for a in t['artists']])])
+            return tracks
+        except Exception as e:
+            logger.warning(f"Yandex Music album lookup failed for {match.group(1)}: {e}")
+            return []
+
+    tracks = await cached_music_metadata(f"ym:album:{match.group(1)}", _load)
+    return [tuple(t) for t in tracks or []]
 
 async def transcribe(s3_uri):
     headers = {"Authorization": f"Api-Key {YSK.get('API_KEY')}"}
     body = {"config": {"specification": {"languageCode": "ru-RU", "audioEncoding": "OGG_OPUS"}}, "folderId": YSK.get("FOLDER_ID"), "audio": {"uri": s3_uri}}
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post("https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize", headers=headers, json=body) as resp:
-                op_id = (await resp.json()).get("id")
+        sess = http_clients.session()
+        async with sess.post("https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize", headers=headers, json=body) as resp:
+            op_id = (await resp.json()).get("id")
         for _ in range(30):
             await asyncio.sleep(5)
-            async with aiohttp.ClientSession() as sess:
-                async with sess.get(f"https://operation.api.cloud.yandex.net/operations/{op_id}", headers=headers) as resp:
-                    data = await resp.json()
-                    if data.get("done"): return " ".join(c["alternatives"][0]["text"] for c in data.get("response", {}).get("chunks", []))
+            async with sess.get(f"https://operation.api.cloud.yandex.net/operations/{op_id}", headers=headers) as resp:
+                data = await resp.json()
+                if data.get("done"): return " ".join(c["alternatives"][0]["text"] for c in data.get("response", {}).get("chunks", []))
     except: return None
     return None
 
@@ -1458,9 +3607,13 @@ async def summarize_text(text):
         "messages": [{"role": "system", "text": YGPT.get("SYSTEM_PROMPT")}, {"role": "user", "text": f"Text to process:\n{text}"}]
     }
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.post("https://llm.api.cloud.yandex.net/foundationModels/v1/completion", headers={"Authorization": f"Api-Key {YGPT['API_KEY']}"}, json=body) as resp:
-                return (await resp.json())["result"]["alternatives"][0]["message"]["text"]
+        async with http_clients.session().post(
+            "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
+            headers={"Authorization": f"Api-Key {YGPT['API_KEY']}"},
+            json=body,
+            timeout=aiohttp.ClientTimeout(total=120),
+        ) as resp:
+            return (await resp.json())["result"]["alternatives"][0]["message"]["text"]
     except: return None
 
 async def update_status(context, chat_id, text, message_obj=None, reply_to_id=None, parse_mode=None):
@@ -1492,23 +3645,16 @@ async def download_tg_file_via_cloud(file_id, dst_path):
     """
     cloud_api = f"https://api.telegram.org/bot{BOT_TOKEN}/getFile"
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(cloud_api, params={"file_id": file_id}, timeout=30) as resp:
-                if resp.status != 200:
-                    return False
-                data = await resp.json()
-                file_path = data.get("result", {}).get("file_path")
-                if not file_path:
-                    return False
-
-            cloud_file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-            async with sess.get(cloud_file_url, timeout=120) as f_resp:
-                if f_resp.status != 200:
-                    return False
-                content = await f_resp.read()
-                with open(dst_path, "wb") as f:
-                    f.write(content)
-                return True
+        async with http_clients.session().get(cloud_api, params={"file_id": file_id}) as resp:
+            if resp.status != 200:
+                return False
+            data = await resp.json()
+            file_path = data.get("result", {}).get("file_path")
+            if not file_path:
+                return False
+
+        cloud_file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+        return await download_direct(cloud_file_url, dst_path) == dst_path
     except Exception as e:
         logger.warning(f"Cloud file fallback failed for {file_id}: {e}")
         return False
@@ -1527,6 +3673,61 @@ def is_stale_message(msg, max_age_sec=MAX_UPDATE_AGE_SEC):
     except Exception:
         return False
 
+
+CACHED_SEND_METHODS = {
+    "audio": ("send_audio", "audio"),
+    "photo": ("send_photo", "photo"),
+    "video": ("send_video", "video"),
+    "document": ("send_document", "document"),
+}
+
+
+async def send_cached_media(context, chat_id, file_id, reply_to_id=None, is_music=False, media_kind=None):
+    """
+    Sends an already uploaded file_id with one Bot API call per known media kind.
+    Returns (message, media_kind). Only legacy entries without a kind probe video -> document.
+    `context` only needs a `.bot`, so the Application works as well.
+    """
+    if media_kind is None and is_music:
+        media_kind = "audio"
+    # A deleted source message must not cost a second round trip.
+    reply_kwargs = {"reply_to_message_id": reply_to_id, "allow_sending_without_reply": True}
+    if media_kind in CACHED_SEND_METHODS:
+        method_name, field = CACHED_SEND_METHODS[media_kind]
+        method = getattr(context.bot, method_name)
+        return await method(chat_id=chat_id, **{field: file_id}, **reply_kwargs), media_kind
+    try:
+        return await context.bot.send_video(chat_id=chat_id, video=file_id, **reply_kwargs), "video"
+    except Exception:
+        return await context.bot.send_document(chat_id=chat_id, document=file_id, **reply_kwargs), "document"
+
+
+async def deliver_cached_media(context, msg, user, txt, cache_link, file_id, media_kind=None, cache_entry=None):
+    """
+    Cached-send path shared by DB cache hits and joined in-flight downloads.
+    cache_entry is the (key, variant) that produced file_id; a probed kind is stored back there.
+    """
+    chat_id = msg.chat_id
+    is_music = any(x in txt for x in MUSIC_MARKERS)
+    try:
+        async with SEND_SEMAPHORE:
+            sent, sent_media_kind = await send_cached_media(
+                context, chat_id, file_id, reply_to_id=msg.message_id, is_music=is_music, media_kind=media_kind
+            )
+
+        if media_kind is None and cache_entry:
+            await remember_media_kind(cache_entry[0], cache_entry[1], file_id, sent_media_kind)
+
+        if sent and sent_media_kind in {"video", "document"}:
+            await attach_share_button(context, sent, file_id, sent_media_kind)
+
+        await save_log(user.id, user.username or "Unknown", chat_id, cache_link, "Cached_Media", file_id, media_kind=sent_media_kind)
+        if sent_media_kind in {"video", "document"}:
+            await maybe_send_donation_prompt(context, msg.chat, user)
+        return True
+    except Exception:
+        return False
+
 async def handle_message(update: Update, context):
     msg = update.effective_message
     if not msg or not msg.text: return
@@ -1567,7 +3768,7 @@ async def handle_message(update: Update, context):
             return await msg.reply_text("YooKassa пока не настроена.")
 
         try:
-            payment_url = await asyncio.to_thread(create_yookassa_donation, amount_rub, user.id)
+            payment_url = await create_yookassa_donation(amount_rub, user.id)
         except Exception as e:
             logger.warning(f"Failed to create YooKassa payment for {user.id}: {e}")
             return await msg.reply_text("Не удалось создать ссылку на оплату. Попробуйте позже.")
@@ -1594,126 +3795,177 @@ async def handle_message(update: Update, context):
     elif "pornhub" in source_low: detected_service = "PornHub"
     elif "pinterest" in source_low or "pin.it" in source_low: detected_service = "Pinterest"
 
-    cached_file_id = await check_db_cache(cache_link)
-    if not cached_file_id and cache_link != source_link:
-        cached_file_id = await check_db_cache(source_link)
-    if cached_file_id:
-        try:
-            sent = None
-            sent_media_kind = None
-            try:
-                async with SEND_SEMAPHORE:
-                    if any(x in txt for x in MUSIC_MARKERS):
-                        sent = await context.bot.send_audio(chat_id=chat_id, audio=cached_file_id, reply_to_message_id=msg.message_id)
-                    else:
-                        try:
-                            sent = await context.bot.send_video(chat_id=chat_id, video=cached_file_id, reply_to_message_id=msg.message_id)
-                            sent_media_kind = "video"
-                        except Exception:
-                            sent = await context.bot.send_document(chat_id=chat_id, document=cached_file_id, reply_to_message_id=msg.message_id)
-                            sent_media_kind = "document"
-            except Exception:
-                async with SEND_SEMAPHORE:
-                    if any(x in txt for x in MUSIC_MARKERS):
-                        sent = await context.bot.send_audio(chat_id=chat_id, audio=cached_file_id, reply_to_message_id=None)
-                    else:
-                        try:
-                            sent = await context.bot.send_video(chat_id=chat_id, video=cached_file_id, reply_to_message_id=None)
-                            sent_media_kind = "video"
-                        except Exception:
-                            sent = await context.bot.send_document(chat_id=chat_id, document=cached_file_id, reply_to_message_id=None)
-                            sent_media_kind = "document"
-
-            if sent and sent_media_kind:
-                await attach_share_button(context, sent, cached_file_id, sent_media_kind)
-            
-            await save_log(user.id, user.username or "Unknown", chat_id, cache_link, "Cached_Media", cached_file_id)
-            if sent_media_kind:
-                await maybe_send_donation_prompt(context, msg.chat, user)
+    # Only local parsing here: short-link expansion happens inside the download task.
+    cache_key = canonical_content_id(source_link) or cache_link
+    cache_variant = media_cache_variant(txt)
+    # Content ID first; normalized/raw links still match entries cached before content IDs.
+    lookup_keys = list(dict.fromkeys([cache_key, cache_link, source_link]))
+    hit_key, cached = await check_db_cache_any(lookup_keys, cache_variant)
+    if cached:
+        if await deliver_cached_media(
+            context, msg, user, txt, cache_link, cached["file_id"],
+            media_kind=cached.get("media_kind"), cache_entry=(hit_key, cache_variant),
+        ):
             return
-        except Exception:
-            logger.warning(f"Cache failed for {cache_link}, downloading again...")
+        for key in lookup_keys:
+            media_cache_lru.invalidate((key, cache_variant))
+        logger.warning(f"Cache failed for {cache_key}, downloading again...")
 
     # Wait for slot
     # Spawn background task so main loop isn't blocked
-    asyncio.create_task(process_download(update, context, txt, source_link, cache_link, detected_service, user, chat_id, msg))
+    asyncio.create_task(resolve_and_process_download(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg))
+
+
+async def resolve_and_process_download(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg):
+    """Expands short links to their content ID and re-checks the cache under it before downloading."""
+    if needs_cache_key_expansion(source_link):
+        try:
+            resolved_key = await resolve_cache_key(source_link)
+        except Exception as e:
+            logger.warning(f"Cache key resolve failed for {source_link}: {e}")
+            resolved_key = cache_key
+        if resolved_key != cache_key:
+            cache_key = resolved_key
+            cache_variant = media_cache_variant(txt)
+            hit_key, cached = await check_db_cache_any([cache_key], cache_variant)
+            if cached:
+                if await deliver_cached_media(
+                    context, msg, user, txt, cache_link, cached["file_id"],
+                    media_kind=cached.get("media_kind"), cache_entry=(hit_key, cache_variant),
+                ):
+                    return
+                media_cache_lru.invalidate((cache_key, cache_variant))
+                logger.warning(f"Cache failed for {cache_key}, downloading again...")
+    await process_download(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg)
+
+def is_album_link(txt):
+    return "music.yandex" in txt and "/album/" in txt and "/track/" not in txt
+
+
+async def process_download(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg):
+    # Audio and video requests for one content ID are different jobs, like their cache entries.
+    inflight_key = (cache_key, media_cache_variant(txt))
+    job = inflight_downloads.get(inflight_key)
+    if job is not None:
+        await _join_inflight_download(job, update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg)
+        return
+
+    # First request for this link owns the job; later ones wait on its outcome.
+    job = asyncio.get_running_loop().create_future()
+    inflight_downloads[inflight_key] = job
+    outcome = None
+    owner = user.id if user else chat_id
+    queue_status = {}
+
+    async def _show_queue_position(position):
+        queue_status["msg"] = await update_status(
+            context, chat_id, STATUS_QUEUED.format(position=position),
+            message_obj=queue_status.get("msg"), reply_to_id=msg.message_id,
+        )
 
-async def process_download(update, context, txt, source_link, cache_link, detected_service, user, chat_id, msg):
-    # Move semaphore here so we block inside the task, not the main loop
     try:
-        async with DOWNLOAD_SEMAPHORE:
-             await _process_download_inner(update, context, txt, source_link, cache_link, detected_service, user, chat_id, msg)
+        if is_album_link(txt):
+            # The album coordinator only fans out; each track takes its own scheduler slot.
+            outcome = await _process_download_inner(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg)
+        else:
+            async with download_scheduler.slot(scheduler_service(detected_service, txt), owner, on_queued=_show_queue_position):
+                outcome = await _process_download_inner(
+                    update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg,
+                    st_msg=queue_status.pop("msg", None),
+                )
     except Exception as e:
          logger.error(f"Processing Error: {e}")
-         await notify_error(update, context, e, "Download Semaphore Block")
+         await notify_error(update, context, e, "Download Scheduler")
+    finally:
+        leftover = queue_status.pop("msg", None)
+        if leftover:
+            try: await leftover.delete()
+            except: pass
+        if inflight_downloads.get(inflight_key) is job:
+            inflight_downloads.pop(inflight_key, None)
+        if not job.done():
+            job.set_result(outcome)
+
+
+async def _join_inflight_download(job, update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg):
+    logger.info(f"🔗 Joined in-flight download for {cache_key}")
+    st_msg = await update_status(context, chat_id, STATUS_ANALYZING, reply_to_id=msg.message_id)
+    try:
+        outcome = await asyncio.shield(job)
+    finally:
+        if st_msg:
+            try: await st_msg.delete()
+            except: pass
+
+    outcome = outcome or {}
+    if outcome.get("file_id"):
+        if await deliver_cached_media(context, msg, user, txt, cache_link, outcome["file_id"], media_kind=outcome.get("media_kind")):
+            return
+        logger.warning(f"Cached send failed for joined download {cache_key}, downloading again...")
+    elif outcome.get("error"):
+        await send_user_error(context, chat_id, outcome["error"], reply_to_id=msg.message_id)
+        return
+
+    # Owner produced nothing reusable (album, lost file_id, failed send): run our own job.
+    await process_download(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg)
 
-async def _process_download_inner(update, context, txt, source_link, cache_link, detected_service, user, chat_id, msg):
-    st_msg, f_path = None, None
+
+async def _process_download_inner(update, context, txt, source_link, cache_link, cache_key, detected_service, user, chat_id, msg, st_msg=None):
+    """Runs one download job. Returns an outcome dict for coalesced waiters or None."""
+    f_path = None
     media_sent = False
+    outcome = None
     try:
-        st_msg = await update_status(context, chat_id, STATUS_ANALYZING, reply_to_id=msg.message_id)
+        st_msg = await update_status(context, chat_id, STATUS_ANALYZING, message_obj=st_msg, reply_to_id=msg.message_id)
 
-        if "music.yandex" in txt and "/album/" in txt and "/track/" not in txt:
+        if is_album_link(txt):
             detected_service = "YandexAlbum"
-            tracks = await asyncio.to_thread(get_ym_album_info, txt)
+            tracks = await get_ym_album_info(txt)
             if not tracks: raise Exception("ERR_EMPTY_ALBUM")
             
             st_msg = await update_status(
                 context, chat_id, STATUS_ALBUM.format(count=len(tracks)), message_obj=st_msg, reply_to_id=msg.message_id
             )
 
-            album_semaphore = asyncio.Semaphore(max(1, ALBUM_TRACK_CONCURRENCY))
-
-            async def _send_album_track(track_title, track_artist):
-                raw_track, f_path_track = None, None
-                try:
-                    dl_url = f"ytsearch1:{track_title} {track_artist}"
-                    raw_track = await generic_download(dl_url, {'noplaylist': True, 'format': 'bestaudio/best'})
-                    if not raw_track:
-                        return
-                    if isinstance(raw_track, str) and (raw_track == "TOO_LARGE" or raw_track.startswith("ERR_")):
-                        return
-
-                    f_path_track = await convert_media(raw_track, to_audio=True)
-                    if not f_path_track or f_path_track == "TOO_LARGE" or not os.path.exists(f_path_track):
-                        return
-
-                    with open(f_path_track, 'rb') as f:
-                        async with SEND_SEMAPHORE:
-                            await context.bot.send_audio(chat_id, f, title=track_title, performer=track_artist)
-                except Exception:
-                    pass
-                finally:
-                    for p in [f_path_track, raw_track]:
-                        if p and isinstance(p, str) and os.path.exists(p):
-                            try:
-                                os.remove(p)
-                            except Exception:
-                                pass
+            async def _album_progress(done, count):
+                nonlocal st_msg
+                st_msg = await update_status(context, chat_id, STATUS_ALBUM_PROGRESS.format(done=done, count=count), message_obj=st_msg)
 
-            async def _bounded_send(track_title, track_artist):
-                async with album_semaphore:
-                    await _send_album_track(track_title, track_artist)
+            sent_count, failed_count = await deliver_album(
+                context, chat_id, user.id if user else chat_id, tracks, detected_service, progress=_album_progress
+            )
+            if not sent_count: raise Exception("ERR_DOWNLOAD_FAILED")
 
-            await asyncio.gather(*(_bounded_send(title, artist) for title, artist in tracks))
-            
             await save_log(user.id, user.username or "Unknown", chat_id, cache_link, detected_service)
-            if st_msg: await st_msg.delete()
+            if failed_count:
+                st_msg = await update_status(
+                    context, chat_id, STATUS_ALBUM_PARTIAL.format(sent=sent_count, count=len(tracks)), message_obj=st_msg
+                )
+            elif st_msg:
+                await st_msg.delete()
             return
 
         f_type, caption, title, artist = "video", "", None, None
         if any(x in txt for x in ["music.yandex", "spotify", "music.youtube"]):
             f_type = "audio"
-            if "music.yandex" in txt: title, artist = await asyncio.to_thread(get_ym_track_info, txt)
-            elif "spotify" in txt: title, artist = await asyncio.to_thread(get_spotify_info, txt)
-            dl_url = f"ytsearch1:{title} {artist}" if (title and artist) else txt
-            raw = await generic_download(dl_url, {'noplaylist': True, 'format': 'bestaudio/best'})
-            if not raw: raise Exception("ERR_DOWNLOAD_FAILED")
-            if raw == "TOO_LARGE": raise Exception("TOO_LARGE")
-            if isinstance(raw, str) and raw.startswith("ERR_"): raise Exception(raw)
-            f_path = await convert_media(raw, to_audio=True)
-            if not f_path: raise Exception("ERR_CONVERSION")
-            if f_path == "TOO_LARGE": raise Exception("TOO_LARGE")
+            if "music.yandex" in txt: title, artist = await get_ym_track_info(txt)
+            elif "spotify" in txt: title, artist = await get_spotify_info(txt)
+            track_key = music_track_key(title, artist)
+            # Same track already uploaded via another link or album
+            cached_track = await check_db_cache(track_key, "audio") if track_key else None
+            if cached_track and await deliver_cached_media(
+                context, msg, user, txt, cache_link, cached_track["file_id"],
+                media_kind="audio", cache_entry=(track_key, "audio"),
+            ):
+                outcome = {"file_id": cached_track["file_id"], "media_kind": "audio"}
+                await upsert_media_cache(cache_key, media_cache_variant(txt), cached_track["file_id"], "audio", detected_service)
+                if st_msg:
+                    try: await st_msg.delete()
+                    except: pass
+                return outcome
+            dl_url = await resolve_track_download_url(title, artist) if track_key else txt
+            f_path = await download_track_audio(dl_url, title, artist)
+            if f_path == "TOO_LARGE" or f_path.startswith("ERR_"): raise Exception(f_path)
             caption = f"{artist} - {title}" if title else ""
         else:
             raw = await download_router(source_link)
@@ -1725,7 +3977,7 @@ async def _process_download_inner(update, context, txt, source_link, cache_link,
             if raw.endswith(('.jpg', '.png', '.jpeg')):
                 f_type = "image"
                 f_path = raw
-            elif detected_service in FORCE_CONVERSION_SERVICES:
+            elif detected_service in FORCE_CONVERSION_SERVICES and not await is_telegram_ready_video(raw):
                 f_path = await convert_media(raw)
                 if f_path == "TOO_LARGE": raise Exception("TOO_LARGE")
                 if not f_path: raise Exception("ERR_CONVERSION")
@@ -1803,20 +4055,36 @@ async def _process_download_inner(update, context, txt, source_link, cache_link,
                 media_sent = True
                 file_id = None
                 sent_media_kind = None
+                delivered_kind = None
+                media_obj = None
                 if f_type == "audio" and getattr(sent, "audio", None):
-                    file_id = sent.audio.file_id
+                    media_obj = sent.audio
+                    delivered_kind = "audio"
                 elif f_type == "image" and getattr(sent, "photo", None):
-                    file_id = sent.photo[-1].file_id
+                    media_obj = sent.photo[-1]
+                    delivered_kind = "photo"
                 elif getattr(sent, "video", None):
-                    file_id = sent.video.file_id
-                    sent_media_kind = "video"
+                    media_obj = sent.video
+                    sent_media_kind = delivered_kind = "video"
                 elif getattr(sent, "document", None):
-                    file_id = sent.document.file_id
-                    sent_media_kind = "document"
+                    media_obj = sent.document
+                    sent_media_kind = delivered_kind = "document"
+                if media_obj:
+                    file_id = media_obj.file_id
 
                 if file_id:
+                    outcome = {"file_id": file_id, "media_kind": delivered_kind}
                     try:
-                        await save_log(user.id, user.username or "Unknown", chat_id, cache_link, detected_service, file_id)
+                        await upsert_media_cache(
+                            cache_key, media_cache_variant(txt), file_id, delivered_kind, detected_service,
+                            file_size=getattr(media_obj, "file_size", None),
+                        )
+                        if delivered_kind == "audio" and music_track_key(title, artist):
+                            await upsert_media_cache(
+                                music_track_key(title, artist), "audio", file_id, "audio", detected_service,
+                                file_size=getattr(media_obj, "file_size", None),
+                            )
+                        await save_log(user.id, user.username or "Unknown", chat_id, cache_link, detected_service, file_id, media_kind=delivered_kind)
                     except Exception as cache_err:
                         logger.warning(f"Cache save skipped after successful send: {cache_err}")
                     if msg.chat.type == "private" and sent_media_kind:
@@ -1837,7 +4105,7 @@ async def _process_download_inner(update, context, txt, source_link, cache_link,
 
         if media_sent:
             logger.warning(f"Post-send exception suppressed for chat {chat_id}: {e}")
-            return
+            return outcome
         
         err_code = str(e).strip()
         if err_code == "SEND_TIMEOUT":
@@ -1846,12 +4114,16 @@ async def _process_download_inner(update, context, txt, source_link, cache_link,
 
         if err_code in USER_ERROR_MESSAGES or err_code.startswith("ERR_"):
             await send_user_error(context, chat_id, err_code, reply_to_id=msg.message_id)
+            if err_code != "ERR_SEND_TIMEOUT":
+                # Waiters share the source-side failure; an upload timeout is ours alone.
+                outcome = {"error": err_code}
         else:
             await notify_error(update, context, e, "Handle Message")
     finally:
         if f_path and os.path.exists(f_path): 
             try: os.remove(f_path)
             except: pass
+    return outcome
 
 
 async def handle_voice_video(update: Update, context):
@@ -1912,9 +4184,8 @@ async def handle_inline_query(update: Update, context):
     if not query:
         return
 
-    purge_expired_share_tokens()
     token = (query.query or "").strip()
-    item = shareable_media.get(token)
+    item = await share_tokens.lookup(token)
     if not item:
         await query.answer([], cache_time=1, is_personal=True)
         return
@@ -2056,8 +4327,7 @@ async def admin_proxy_view(query, context, proxy_id, notice=None):
 
 async def admin_proxy_prolong(query, context, proxy_id):
     try:
-        payload = await asyncio.to_thread(
-            _proxy6_call_sync,
+        payload = await _proxy6_call(
             "prolong",
             {"period": PROXY6_PROLONG_DAYS, "ids": str(proxy_id)},
         )
@@ -2074,7 +4344,7 @@ async def admin_proxy_prolong(query, context, proxy_id):
 
 async def admin_proxy_delete(query, context, proxy_id):
     try:
-        await asyncio.to_thread(_proxy6_call_sync, "delete", {"ids": str(proxy_id)})
+        await _proxy6_call("delete", {"ids": str(proxy_id)})
     except Exception as e:
         await admin_proxy_view(query, context, proxy_id, notice=f"❌ {_format_proxy6_error(e)}")
         return
@@ -2159,7 +4429,7 @@ async def admin_show_chats(query, context):
     try:
         async with db_pool.acquire() as conn:
             # unique chat_ids (groups/channels/users)
-            chat_rows = await conn.fetch("SELECT DISTINCT chat_id FROM requests_log")
+            chat_rows = await conn.fetch("SELECT chat_id FROM chat_rollup")
             
         users = []
         chats = []
@@ -2231,7 +4501,7 @@ async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         async with db_pool.acquire() as conn:
             # Get all unique users and chats
-            rows = await conn.fetch("SELECT DISTINCT chat_id FROM requests_log UNION SELECT DISTINCT user_id AS chat_id FROM requests_log")
+            rows = await conn.fetch("SELECT chat_id FROM chat_rollup UNION SELECT user_id AS chat_id FROM user_rollup")
             
         targets = set(r['chat_id'] for r in rows if r['chat_id'])
         
@@ -2273,6 +4543,7 @@ async def admin_direct_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 def main():
+    start_ydl_process_pool()
     threading.Thread(target=cleanup_loop, daemon=True).start()
     api_base = TELEGRAM_API_BASE_URL.rstrip("/")
     app = (
@@ -2285,6 +4556,7 @@ def main():
         .write_timeout(TG_WRITE_TIMEOUT)
         .pool_timeout(TG_POOL_TIMEOUT)
         .post_init(init_db)
+        .post_shutdown(shutdown_db)
         .build()
     )
     